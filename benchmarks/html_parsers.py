@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2009-2015 Ben Kurtovic <ben.kurtovic@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Compare the speed of the HTML parsers used for copyvio sources.
+
+Runs the default BeautifulSoup parser and the streaming lxml parser
+(``htmlParser: lxml`` in the search config) over the same corpus of HTML
+documents, checks that they extract the same text, and prints their timings.
+The corpus is generated from a fixed seed, so results are comparable between
+runs; alternatively, pass a directory of saved HTML files to use instead.
+
+Usage: python benchmarks/html_parsers.py [corpus_dir] [--repeat N]
+"""
+
+from argparse import ArgumentParser
+from os import listdir, path
+import random
+import sys
+from timeit import default_timer
+
+sys.path.insert(0, path.join(path.dirname(__file__), ".."))
+from earwigbot.wiki.copyvios.parsers import get_parser
+
+WORDS = (u"the of and to in is was for on as by with that from at his her "
+         u"which an were are it be this also first had has their one new "
+         u"after city world war film year school university team album song "
+         u"river station church game season caf\xe9 na\xefve \xfcber").split()
+
+def _sentence(rand):
+    """Return a random sentence."""
+    words = [rand.choice(WORDS) for _ in xrange(rand.randint(5, 25))]
+    return u" ".join(words).capitalize() + u"."
+
+def _document(rand, size):
+    """Return a random HTML document with roughly *size* paragraphs.
+
+    Most documents declare their encoding as UTF-8; some don't declare one
+    at all, and are encoded as UTF-8 or Latin-1, so the parsers have to
+    detect it.
+    """
+    encoding = rand.choice(["utf8", "utf8", "utf8", None, "latin1"])
+    meta = u"<meta charset='utf-8'>" if encoding == "utf8" else u""
+    parts = [u"<!DOCTYPE html><html><head>", meta,
+             u"<title>", _sentence(rand), u"</title>",
+             u"<style>body { color: #333; } p > a { margin: 0 }</style>",
+             u"<script>var x = 1; if (x < 2) { x++; }</script></head><body>",
+             u"<div id='nav'><ul>"]
+    for _ in xrange(rand.randint(5, 20)):
+        parts.append(u"<li><a href='/x'>{0}</a></li>".format(
+            rand.choice(WORDS)))
+    parts.append(u"</ul></div><div id='content'>")
+    for _ in xrange(size):
+        kind = rand.random()
+        if kind < 0.6:
+            parts.append(u"<p>{0} <b>{1}</b> {2} &amp; <a href='#'>{3}</a></p>"
+                         .format(_sentence(rand), rand.choice(WORDS),
+                                 _sentence(rand), rand.choice(WORDS)))
+        elif kind < 0.7:
+            parts.append(u"<!-- {0} -->".format(_sentence(rand)))
+        elif kind < 0.8:
+            parts.append(u"<script>document.write('{0}');</script>".format(
+                rand.choice(WORDS)))
+        elif kind < 0.9:
+            cells = u"".join(u"<td>{0}</td>".format(rand.choice(WORDS))
+                             for _ in xrange(4))
+            parts.append(u"<table><tr>{0}</tr></table>".format(cells))
+        else:
+            parts.append(u"<h2>{0}</h2>".format(_sentence(rand)))
+    parts.append(u"</div></body></html>")
+    return u"".join(parts).encode(encoding or "utf8")
+
+def get_corpus(directory=None, seed=1, count=60):
+    """Return a list of HTML documents to benchmark with, as byte strings."""
+    if directory:
+        docs = []
+        for filename in sorted(listdir(directory)):
+            with open(path.join(directory, filename), "rb") as fp:
+                docs.append(fp.read())
+        return docs
+    rand = random.Random(seed)
+    return [_document(rand, rand.choice([10, 50, 200, 1000]))
+            for _ in xrange(count)]
+
+def run(docs, args, repeat):
+    """Parse every document *repeat* times; return the best time and texts."""
+    handler = get_parser("text/html")
+    best = None
+    for _ in xrange(repeat):
+        start = default_timer()
+        texts = [handler(doc, args).parse() for doc in docs]
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, texts
+
+def main():
+    argparser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument("corpus_dir", nargs="?",
+                           help="directory of HTML files to parse")
+    argparser.add_argument("--repeat", type=int, default=3,
+                           help="number of runs; the best is reported")
+    options = argparser.parse_args()
+
+    docs = get_corpus(options.corpus_dir)
+    size = sum(len(doc) for doc in docs) / 1024.0 ** 2
+    print "Corpus: {0} documents, {1:.1f} MiB".format(len(docs), size)
+
+    bs4_time, bs4_texts = run(docs, {}, options.repeat)
+    lxml_time, lxml_texts = run(docs, {"htmlParser": "lxml"}, options.repeat)
+    same = sum(1 for a, b in zip(bs4_texts, lxml_texts) if a == b)
+
+    print "BeautifulSoup: {0:.3f} s".format(bs4_time)
+    print "lxml stream:   {0:.3f} s ({1:.1f}x faster)".format(
+        lxml_time, bs4_time / lxml_time)
+    print "Identical text: {0}/{1} documents".format(same, len(docs))
+    return 0 if same == len(docs) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -51,13 +51,13 @@ class Link(Command):
                 else:
                     self.reply(data, "What do you want me to link to?")
                 return
-            pagename = " ".join(data.args)
+            pagename = self.site.normalize_title(" ".join(data.args))
             link = self.site.get_page(pagename).url.encode("utf8")
             self.reply(data, link)
 
     def parse_line(self, line):
         """Return a list of links within a line of text."""
-        results = []
+        titles = []
 
         # Destroy {{{template parameters}}}:
         line = re.sub("\{\{\{(.*?)\}\}\}", "", line)
@@ -67,13 +67,19 @@ class Link(Command):
         if links:
             # re.findall() returns a list of tuples, but we only want the 2nd
             # item in each tuple:
-            results = [self.site.get_page(name[1]).url for name in links]
+            titles = [name[1] for name in links]
 
         # Find all {{templates}}
         templates = re.findall("(\{\{(.*?)(\||\}\}))", line)
         if templates:
-            p_tmpl = lambda name: self.site.get_page("Template:" + name).url
-            templates = [p_tmpl(i[1]) for i in templates]
-            results += templates
+            titles += ["Template:" + i[1] for i in templates]
 
+        # Normalize titles so the same page isn't linked more than once:
+        results = []
+        seen = set()
+        for title in titles:
+            title = self.site.normalize_title(title)
+            if title not in seen:
+                seen.add(title)
+                results.append(self.site.get_page(title).url)
         return results
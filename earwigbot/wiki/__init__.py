@@ -45,6 +45,7 @@ of your :py:class:`~earwigbot.wiki.site.Site` (and thus,
 
 from earwigbot.wiki.category import *
 from earwigbot.wiki.constants import *
+from earwigbot.wiki.dump import *
 from earwigbot.wiki.page import *
 from earwigbot.wiki.site import *
 from earwigbot.wiki.sitesdb import *
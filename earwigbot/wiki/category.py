@@ -20,7 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from earwigbot.wiki.page import Page
+from earwigbot.wiki.page import Page, PageRef
 
 __all__ = ["Category"]
 
@@ -62,7 +62,7 @@ class Category(Page):
         """Iterate over all members of the category."""
         return self.get_members()
 
-    def _get_members_via_api(self, limit, follow):
+    def _get_members_via_api(self, limit, follow, refs):
         """Iterate over Pages in the category using the API."""
         params = {"action": "query", "list": "categorymembers",
                   "cmtitle": self.title, "continue": ""}
@@ -72,7 +72,11 @@ class Category(Page):
             result = self.site.api_query(**params)
             for member in result["query"]["categorymembers"]:
                 title = member["title"]
-                yield self.site.get_page(title, follow_redirects=follow)
+                if refs:
+                    yield PageRef(self.site, title, member["ns"],
+                                  member["pageid"])
+                else:
+                    yield self.site.get_page(title, follow_redirects=follow)
 
             if "continue" in result:
                 params.update(result["continue"])
@@ -81,7 +85,7 @@ class Category(Page):
             else:
                 break
 
-    def _get_members_via_sql(self, limit, follow):
+    def _get_members_via_sql(self, limit, follow, refs):
         """Iterate over Pages in the category using SQL."""
         query = """SELECT page_title, page_namespace, page_id FROM page
                    JOIN categorylinks ON page_id = cl_from
@@ -102,8 +106,11 @@ class Category(Page):
                 title = u":".join((namespace, base))
             else:  # Avoid doing a silly (albeit valid) ":Pagename" thing
                 title = base
-            yield self.site.get_page(title, follow_redirects=follow,
-                                     pageid=row[2])
+            if refs:
+                yield PageRef(self.site, title, row[1], row[2])
+            else:
+                yield self.site.get_page(title, follow_redirects=follow,
+                                         pageid=row[2])
 
     def _get_size_via_api(self, member_type):
         """Return the size of the category using the API."""
@@ -173,7 +180,7 @@ class Category(Page):
         """
         return self._get_size("subcats")
 
-    def get_members(self, limit=None, follow_redirects=None):
+    def get_members(self, limit=None, follow_redirects=None, refs=False):
         """Iterate over Pages in the category.
 
         If *limit* is given, we will provide this many pages, or less if the
@@ -183,6 +190,12 @@ class Category(Page):
         <earwigbot.wiki.site.Site.get_page>`; it defaults to ``None``, which
         will use the value passed to our :py:meth:`__init__`.
 
+        If *refs* is ``True``, we will yield compact
+        :py:class:`~earwigbot.wiki.page.PageRef`\ s instead of full Pages,
+        which use far less memory when many members are kept around. Use
+        :py:meth:`PageRef.to_page() <earwigbot.wiki.page.PageRef.to_page>` to
+        get the full Page later.
+
         This will use either the API or SQL depending on which are enabled and
         the amount of lag on each. This is handled by :py:meth:`site.delegate()
         <earwigbot.wiki.site.Site.delegate>`.
@@ -205,4 +218,4 @@ class Category(Page):
         }
         if follow_redirects is None:
             follow_redirects = self._follow_redirects
-        return self.site.delegate(services, (limit, follow_redirects))
+        return self.site.delegate(services, (limit, follow_redirects, refs))
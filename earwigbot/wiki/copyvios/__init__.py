@@ -20,19 +20,105 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from time import sleep, time
+from Queue import Queue
+from threading import Event, Thread
+from time import time
 from urllib2 import build_opener
 
 from earwigbot import exceptions, importer
-from earwigbot.wiki.copyvios.markov import MarkovChain
+from earwigbot.wiki.copyvios.cache import ArticleChainCache, SourceCache
+from earwigbot.wiki.copyvios.markov import HashedMarkovChain, MarkovChain
 from earwigbot.wiki.copyvios.parsers import ArticleTextParser
-from earwigbot.wiki.copyvios.search import YahooBOSSSearchEngine
+from earwigbot.wiki.copyvios.search import (
+    CachedSearchEngine, ThrottledSearchEngine, YahooBOSSSearchEngine)
+from earwigbot.wiki.copyvios import workers
 from earwigbot.wiki.copyvios.workers import (
-    globalize, localize, CopyvioWorkspace)
+    globalize, localize, cache_sources, uncache_sources, CopyvioWorkerPool,
+    CopyvioWorkspace)
 
 oauth = importer.new("oauth2")
 
-__all__ = ["CopyvioMixIn", "globalize", "localize"]
+__all__ = ["CopyvioMixIn", "copyvio_check_many", "cache_articles",
+           "uncache_articles", "globalize", "localize", "cache_sources",
+           "uncache_sources", "CopyvioWorkerPool"]
+
+_MAX_QUERIES = 15  # Default search limit for a check
+_article_chains = ArticleChainCache()
+
+def cache_articles(max_entries=100, max_size=2000000):
+    """Set the limits of the cache of article chains shared by all pages.
+
+    Articles' chains are cached by default, so that checking an article again
+    doesn't require building its chain from scratch; see
+    :class:`.ArticleChainCache` for the meaning of *max_entries* and
+    *max_size*. Calling this replaces the cache with an empty one.
+    """
+    global _article_chains
+    _article_chains = ArticleChainCache(max_entries, max_size)
+
+def uncache_articles():
+    """Stop caching article chains; they will be built for every check."""
+    global _article_chains
+    _article_chains = None
+
+def copyvio_check_many(pages, max_concurrent=4, max_total_queries=None,
+                       priority=-1, **kwargs):
+    """Check many pages for copyright violations, yielding results.
+
+    This is a generator of ``(page, result)`` tuples, in the order the checks
+    finish. Up to *max_concurrent* pages are checked at once, each with
+    :py:meth:`CopyvioMixIn.copyvio_check`, to which *kwargs* (like
+    *min_confidence* or *cache*) are passed. Checks run with the given
+    *priority* (low by default, so interactive checks sharing the workers go
+    first) and share a source cache, so a URL that comes up for several
+    pages (like a mirror) is only downloaded once; if :func:`cache_sources`
+    was called, the process-wide cache is used instead.
+
+    *max_total_queries* limits the number of search engine queries made for
+    the whole batch (queries answered by a query cache don't count). Once it
+    runs out, remaining pages are only checked against the links in their
+    wikitext.
+
+    If a check raises an exception (like :exc:`.CopyvioCheckError`, or
+    :exc:`.PageNotFoundError` for a missing page), the exception is yielded
+    instead of a result, and the check's queries are returned to the budget.
+    """
+    pages = list(pages)
+    if not workers._source_cache and "source_cache" not in kwargs:
+        kwargs["source_cache"] = SourceCache()
+    per_check = kwargs.pop("max_queries", _MAX_QUERIES)
+    budget = max_total_queries
+    finished = Queue()
+
+    def run(page, max_queries):
+        try:
+            result = page.copyvio_check(max_queries=max_queries,
+                                        priority=priority, **kwargs)
+        except Exception as exc:  # Always report back, or we'd wait forever
+            result = exc
+        finished.put((page, max_queries, result))
+
+    running = 0
+    while pages or running:
+        while pages and running < max_concurrent:
+            allowed = per_check
+            if budget is not None:
+                allowed = max(min(per_check, budget), 0)
+                budget -= allowed
+            thread = Thread(target=run, args=(pages.pop(0), allowed),
+                            name="cvbatch-{0}".format(len(pages)))
+            thread.daemon = True
+            thread.start()
+            running += 1
+
+        page, allowed, result = finished.get()
+        running -= 1
+        if budget is not None:
+            if isinstance(result, Exception):
+                budget += allowed
+            else:
+                budget += allowed - (result.queries - result.cached_queries)
+        yield page, result
 
 class CopyvioMixIn(object):
     """
@@ -58,6 +144,12 @@ class CopyvioMixIn(object):
         *engine* argument within our config; for example, if *engine* is
         "Yahoo! BOSS", we'll use YahooBOSSSearchEngine for querying.
 
+        The engine is wrapped in a ThrottledSearchEngine, limited to
+        *searchRate* queries per second (default 1) and *searchConcurrency*
+        simultaneous queries (default 1) from our config. If our config has a
+        *query_cache*, it is also wrapped in a CachedSearchEngine so that
+        repeated queries are answered from the cache without being throttled.
+
         Raises UnknownSearchEngineError if the 'engine' listed in our config is
         unknown to us, and UnsupportedSearchEngineError if we are missing a
         required package or module, like oauth2 for "Yahoo! BOSS".
@@ -73,12 +165,83 @@ class CopyvioMixIn(object):
                 raise exceptions.UnsupportedSearchEngineError(e)
             opener = build_opener()
             opener.addheaders = self._addheaders
-            return YahooBOSSSearchEngine(credentials, opener)
+            searcher = YahooBOSSSearchEngine(credentials, opener)
+        else:
+            raise exceptions.UnknownSearchEngineError(engine)
+
+        searcher = ThrottledSearchEngine(
+            searcher, self._search_config.get("searchRate", 1),
+            self._search_config.get("searchConcurrency", 1))
+
+        query_cache = self._search_config.get("query_cache")
+        if query_cache:
+            return CachedSearchEngine(searcher, query_cache)
+        return searcher
+
+    def _get_chain_class(self):
+        """Return the class used to build Markov chains for comparisons.
+
+        This is :py:class:`.MarkovChain` unless *chainType* in our config is
+        ``"hashed"``, in which case it is the much more compact
+        :py:class:`.HashedMarkovChain`. Hashed chains give the same
+        confidences, but can't be used to highlight shared text.
+        """
+        if self._search_config.get("chainType") == "hashed":
+            return HashedMarkovChain
+        return MarkovChain
+
+    def _get_parser_args(self):
+        """Return the arguments given to the parsers of source documents.
 
-        raise exceptions.UnknownSearchEngineError(engine)
+        For now, this is just *htmlParser* from our config, which can be
+        ``"lxml"`` to use a fast streaming HTML parser instead of
+        BeautifulSoup.
+        """
+        return {"htmlParser": self._search_config.get("htmlParser")}
+
+    def _get_article_chain(self, parser):
+        """Return a Markov chain of the article text in the given parser.
+
+        Chains are kept in a cache shared by all pages, so checking an article
+        again will reuse its old chain if it hasn't changed, or update it with
+        just the modified paragraphs if it has been edited since, unless
+        :func:`uncache_articles` was called.
+        """
+        cache = _article_chains
+        if not cache:
+            return self._get_chain_class()(parser.strip())
+        return cache.get_chain(
+            self.site.name, self.pageid, self.lastrevid, parser,
+            self._get_chain_class())
+
+    def _get_cached_result(self, cache, parser, min_confidence, max_time,
+                           pool, callback):
+        """Return a result for this revision from a ResultCache, or None.
 
-    def copyvio_check(self, min_confidence=0.75, max_queries=15, max_time=-1,
-                      no_searches=False, no_links=False, short_circuit=True):
+        If the cached result has a best source, it is compared against the
+        article again, so confidences and chains are up to date.
+        """
+        result = cache.get(self.site.name, self.pageid, self.lastrevid)
+        if not result:
+            return None
+        log = u"Using cached copyvio check result for [[{0}]]"
+        self._logger.info(log.format(self.title))
+        if not result.url:
+            result.article_chain = self._get_article_chain(parser)
+            return result
+
+        max_time = max_time if max_time > 0 else 30
+        new = self.copyvio_compare(result.url, min_confidence, max_time, pool,
+                                   callback)
+        new.queries = new.cached_queries = result.queries
+        new.possible_miss = result.possible_miss
+        new.cached = True
+        return new
+
+    def copyvio_check(self, min_confidence=0.75, max_queries=_MAX_QUERIES,
+                      max_time=-1, no_searches=False, no_links=False,
+                      short_circuit=True, cache=None, pool=None, priority=0,
+                      source_cache=None, callback=None):
         """Check the page for copyright violations.
 
         Returns a :class:`.CopyvioCheckResult` object with information on the
@@ -107,6 +270,36 @@ class CopyvioMixIn(object):
         remaining URLs and web queries, but setting *short_circuit* to
         ``False`` will prevent this.
 
+        *cache* can be a :class:`.ResultCache` to remember results by page
+        revision. If the current revision has been checked before, no searches
+        are made: the best source found last time is compared again with
+        :py:meth:`copyvio_compare`, and the result is marked as
+        :py:attr:`~.CopyvioCheckResult.cached`. The cache isn't used at all
+        by checks run with *no_searches* or *no_links*, and only complete
+        checks are stored: not those stopped or timed out, or limited to
+        fewer than the default 15 queries.
+
+        Unless :func:`.globalize` was called, sources are fetched by the
+        threads of a :class:`.CopyvioWorkerPool`: *pool* if given, or else a
+        shared default pool. Either is grown to *workers* threads from our
+        config (default 8) if it is smaller.
+
+        When checks share workers, each gets a share of them proportional to
+        ``4 ** priority``: interactive checks can use a *priority* of ``1``
+        so they aren't slowed down much by batch checks using ``-1``. A check
+        also never holds more than *maxDomains* from our config (if set)
+        workers at once. *source_cache* can be a :class:`.SourceCache` to use
+        for this check instead of the one set up by :func:`.cache_sources`.
+
+        *callback* can be a function to follow the check's progress, like to
+        show partial results. It's called as ``callback(event, source,
+        confidence)`` whenever a :class:`.CopyvioSource` is ``"queued"``,
+        ``"started"``, ``"fetched"``, ``"compared"``, or ``"skipped"``, where
+        *confidence* is the best confidence found so far. It's called from
+        worker threads, so it should return quickly; if it returns ``True``,
+        the check is stopped and its result is returned with the sources
+        compared so far. See also :py:meth:`copyvio_check_iter`.
+
         Raises :exc:`.CopyvioCheckError` or subclasses
         (:exc:`.UnknownSearchEngineError`, :exc:`.SearchQueryError`, ...) on
         errors.
@@ -115,12 +308,28 @@ class CopyvioMixIn(object):
         self._logger.info(log.format(self.title))
         searcher = self._get_search_engine()
         parser = ArticleTextParser(self.get())
-        article = MarkovChain(parser.strip())
+        if no_searches or no_links:
+            cache = None  # Results of partial checks aren't comparable
+        if cache:
+            result = self._get_cached_result(cache, parser, min_confidence,
+                                             max_time, pool, callback)
+            if result:
+                return result
+        start = time()
+        article = self._get_article_chain(parser)
+        article_time = time() - start
         workspace = CopyvioWorkspace(
             article, min_confidence, max_time, self._logger, self._addheaders,
-            short_circuit=short_circuit)
+            num_workers=self._search_config.get("workers", 8),
+            short_circuit=short_circuit, parser_args=self._get_parser_args(),
+            pool=pool, priority=priority,
+            max_domains=self._search_config.get("maxDomains"),
+            source_cache=source_cache, callback=callback)
+        workspace.timings["article"] = article_time
         if self._exclusions_db:
+            start = time()
             self._exclusions_db.sync(self.site.name)
+            workspace.timings["exclusions"] = time() - start
             exclude = lambda u: self._exclusions_db.check(self.site.name, u)
         else:
             exclude = None
@@ -133,24 +342,77 @@ class CopyvioMixIn(object):
         if not no_links:
             workspace.enqueue(parser.get_links(), exclude)
         num_queries = 0
+        complete = True
         if not no_searches:
+            start = time()
             chunks = parser.chunk(self._search_config["nltk_dir"], max_queries)
-            for chunk in chunks:
-                if short_circuit and workspace.finished:
-                    workspace.possible_miss = True
-                    break
-                log = u"[[{0}]] -> querying {1} for {2!r}"
-                self._logger.debug(log.format(self.title, searcher.name, chunk))
-                workspace.enqueue(searcher.search(chunk), exclude)
-                num_queries += 1
-                sleep(1)
+            workspace.timings["chunk"] = time() - start
+            if len(chunks) == max_queries and max_queries < _MAX_QUERIES:
+                complete = False  # Cut short by a reduced query budget
+            log = u"[[{0}]] -> querying {1} for {2} chunks"
+            self._logger.debug(log.format(self.title, searcher.name,
+                                          len(chunks)))
+            num_threads = self._search_config.get("searchConcurrency", 1)
+            start = time()
+            num_queries = workspace.search(searcher, chunks, exclude,
+                                           num_threads)
+            workspace.timings["search"] = time() - start
 
+        start = time()
         workspace.wait()
+        workspace.timings["wait"] = time() - start
         result = workspace.get_result(num_queries)
+        if isinstance(searcher, CachedSearchEngine):
+            result.cached_queries = searcher.hits
         self._logger.info(result.get_log_message(self.title))
+        if workspace.stopped or workspace.timed_out:
+            complete = False
+        if cache and complete:
+            cache.set(self.site.name, self.pageid, self.lastrevid, result)
         return result
 
-    def copyvio_compare(self, url, min_confidence=0.75, max_time=30):
+    def copyvio_check_iter(self, **kwargs):
+        """Check the page for copyright violations, yielding progress.
+
+        This is a generator version of :py:meth:`copyvio_check`, which takes
+        the same arguments (except *callback*). It yields ``(event, source,
+        confidence)`` tuples as the check goes on, like the ones passed to
+        *callback*; the last one is ``("finished", result, confidence)``,
+        where *result* is the :class:`.CopyvioCheckResult`. Errors are raised
+        from the generator. If it's closed early (like by breaking out of a
+        loop over it), the check is stopped at its next update.
+        """
+        updates = Queue()
+        closed = Event()
+
+        def callback(event, source, confidence):
+            updates.put((event, source, confidence))
+            return closed.is_set()
+
+        def run():
+            try:
+                result = self.copyvio_check(callback=callback, **kwargs)
+            except Exception as exc:
+                updates.put((None, exc, None))
+            else:
+                updates.put(("finished", result, result.confidence))
+
+        thread = Thread(target=run, name="cvcheck-{0}".format(self.pageid))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                event, item, confidence = updates.get()
+                if event is None:
+                    raise item
+                yield event, item, confidence
+                if event == "finished":
+                    return
+        finally:
+            closed.set()
+
+    def copyvio_compare(self, url, min_confidence=0.75, max_time=30,
+                        pool=None, callback=None):
         """Check the page like :py:meth:`copyvio_check` against a specific URL.
 
         This is essentially a reduced version of :meth:`copyvio_check` - a
@@ -168,17 +430,24 @@ class CopyvioMixIn(object):
         be stored for data retention reasons, so a fresh comparison is made
         using this function.
 
-        Since no searching is done, neither :exc:`.UnknownSearchEngineError`
-        nor :exc:`.SearchQueryError` will be raised.
+        *pool* and *callback* are used like in :meth:`copyvio_check`. Since no
+        searching is done, neither :exc:`.UnknownSearchEngineError` nor
+        :exc:`.SearchQueryError` will be raised.
         """
         log = u"Starting copyvio compare for [[{0}]] against {1}"
         self._logger.info(log.format(self.title, url))
-        article = MarkovChain(ArticleTextParser(self.get()).strip())
+        start = time()
+        article = self._get_article_chain(ArticleTextParser(self.get()))
+        article_time = time() - start
         workspace = CopyvioWorkspace(
             article, min_confidence, max_time, self._logger, self._addheaders,
-            max_time, 1)
+            max_time, 1, parser_args=self._get_parser_args(), pool=pool,
+            callback=callback)
+        workspace.timings["article"] = article_time
         workspace.enqueue([url])
+        start = time()
         workspace.wait()
+        workspace.timings["wait"] = time() - start
         result = workspace.get_result()
         self._logger.info(result.get_log_message(self.title))
         return result
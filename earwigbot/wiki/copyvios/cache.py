@@ -0,0 +1,509 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2009-2015 Ben Kurtovic <ben.kurtovic@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from collections import OrderedDict
+from hashlib import sha1
+import json
+from os import listdir, makedirs, path, remove, rename
+import re
+import sqlite3 as sqlite
+from threading import Lock
+from time import time
+
+from earwigbot.wiki.copyvios.result import CopyvioCheckResult
+
+__all__ = ["ArticleChainCache", "QueryCache", "ResultCache", "SourceCache"]
+
+class ArticleChainCache(object):
+    """
+    **EarwigBot: Wiki Toolset: Article Chain Cache**
+
+    Remembers the Markov chains built for recently checked articles, so that
+    checking a page again doesn't require building its chain from scratch. If
+    the page is unchanged, its cleaned text and chain are reused as-is; if it
+    has a new revision, the old chain is patched with only the paragraphs that
+    changed (see :py:meth:`.MarkovChain.patch`).
+
+    Entries are keyed by site name and page ID, and the least recently used
+    ones are dropped once there are more than *max_entries*, or once their
+    total size is more than *max_size*. An entry's size is the length of the
+    article's raw and stripped text plus the number of ngrams in its chain,
+    which is a rough measure of its memory use. This is thread-safe; by
+    default, one instance is shared by all pages (see
+    :py:func:`.cache_articles`).
+    """
+
+    def __init__(self, max_entries=100, max_size=2000000):
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    def __repr__(self):
+        """Return the canonical string representation of the cache."""
+        res = "ArticleChainCache(max_entries={0!r}, max_size={1!r})"
+        return res.format(self._max_entries, self._max_size)
+
+    def __str__(self):
+        """Return a nice string representation of the cache."""
+        return "<ArticleChainCache of {0} articles>".format(len(self._entries))
+
+    def _get(self, key):
+        """Return the entry for the given key, or None if it isn't cached."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._entries[key] = entry  # Mark as most recently used
+            return entry
+
+    def _set(self, key, entry):
+        """Store an entry, dropping the least recently used ones if needed."""
+        revid, text, clean, chain = entry[:4]
+        size = len(text) + len(clean) + chain.size
+        if size > self._max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._size -= old[4]
+            self._entries[key] = (revid, text, clean, chain, size)
+            self._size += size
+            while (len(self._entries) > self._max_entries or
+                   self._size > self._max_size):
+                self._size -= self._entries.popitem(last=False)[1][4]
+
+    def get_chain(self, site, pageid, revid, parser, chain_class):
+        """Return a chain of the article text in the given parser.
+
+        *site* is the name of the article's site, and *pageid* and *revid* are
+        its page ID and the ID of the revision the parser's text comes from.
+        The parser's :py:attr:`clean` attribute is set as if its
+        :py:meth:`~.ArticleTextParser.strip` method had been called, which is
+        avoided entirely when the revision is cached. *chain_class* is the type
+        of chain to build.
+        """
+        key = (site, pageid)
+        entry = self._get(key)
+        if entry:
+            old_revid, old_text, old_clean, old_chain = entry[:4]
+            if type(old_chain) is not chain_class:
+                entry = None
+            elif old_revid == revid and old_text == parser.text:
+                parser.clean = old_clean
+                return old_chain
+
+        clean = parser.strip()
+        if entry:
+            chain = old_chain.patch(old_clean, clean)
+        else:
+            chain = chain_class(clean)
+        self._set(key, (revid, parser.text, clean, chain))
+        return chain
+
+    def clear(self):
+        """Remove all articles from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class SourceCache(object):
+    """
+    **EarwigBot: Wiki Toolset: Source Cache**
+
+    Stores the parsed text of recently fetched source URLs, so that sources
+    that show up in many checks (like Wikipedia mirrors) don't have to be
+    downloaded and parsed each time. This is thread-safe and shared by all
+    copyvio workers in the process; see :py:func:`.cache_sources`.
+
+    Texts are kept for *ttl* seconds, unless the server's ``Cache-Control``
+    header asks for less (or for nothing to be stored at all). Once expired,
+    a text that came with an ``ETag`` can be revalidated with a conditional
+    request instead of being downloaded again. Texts are dropped in least
+    recently used order when their total size exceeds *max_size* bytes. If
+    *cache_dir* is given, texts are also stored there as files, which outlive
+    the memory cache and the process itself. Files are deleted once they have
+    been expired for at least *ttl* seconds, whether or not they could still
+    be revalidated; see :py:meth:`prune`.
+    """
+    _MAX_AGE = re.compile(r"max-age\s*=\s*(\d+)", re.I)
+
+    def __init__(self, ttl=3600, max_size=64 * 1024 ** 2, cache_dir=None):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+        self._next_prune = 0
+
+        if cache_dir and not path.isdir(cache_dir):
+            makedirs(cache_dir)
+
+    def __repr__(self):
+        """Return the canonical string representation of the cache."""
+        res = "SourceCache(ttl={0!r}, max_size={1!r}, cache_dir={2!r})"
+        return res.format(self._ttl, self._max_size, self._cache_dir)
+
+    def __str__(self):
+        """Return a nice string representation of the cache."""
+        res = "<SourceCache of {0} sources ({1} bytes)>"
+        return res.format(len(self._entries), self._size)
+
+    def _get_expiry(self, headers):
+        """Return when a response with the given headers should expire.
+
+        Returns None if the response shouldn't be cached at all.
+        """
+        control = headers.get("Cache-Control", "").lower()
+        if "no-store" in control:
+            return None
+        ttl = self._ttl
+        if "no-cache" in control:
+            ttl = 0
+        else:
+            match = self._MAX_AGE.search(control)
+            if match:
+                ttl = min(ttl, int(match.group(1)))
+        return time() + ttl
+
+    def _get_filename(self, url):
+        """Return the name of the file storing the given URL on disk."""
+        return path.join(self._cache_dir, sha1(url.encode("utf8")).hexdigest())
+
+    def _load_from_disk(self, url):
+        """Return the entry for the given URL from the disk tier, or None."""
+        try:
+            with open(self._get_filename(url), "rb") as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if data["url"] != url:  # Hash collision; very unlikely
+            return None
+        return data["text"], data["expires"], data["etag"]
+
+    def _save_to_disk(self, url, entry):
+        """Write the given entry for a URL to the disk tier."""
+        text, expires, etag = entry[:3]
+        filename = self._get_filename(url)
+        data = {"url": url, "text": text, "expires": expires, "etag": etag}
+        try:
+            with open(filename + ".tmp", "wb") as fp:
+                json.dump(data, fp)
+            rename(filename + ".tmp", filename)
+        except (IOError, OSError):
+            pass
+
+    def _remove_from_disk(self, url):
+        """Delete the file storing the given URL, if there is one."""
+        try:
+            remove(self._get_filename(url))
+        except OSError:
+            pass
+
+    def _prune_disk(self):
+        """Delete files from the disk tier that expired a while ago.
+
+        Entries never expire later than *ttl* seconds after being written,
+        so a file that was last modified more than twice that long ago has
+        been stale for at least *ttl* seconds. Only file times are checked,
+        so this is cheap even for large caches.
+        """
+        cutoff = time() - 2 * self._ttl
+        self._next_prune = time() + self._ttl
+        try:
+            filenames = listdir(self._cache_dir)
+        except OSError:
+            return
+        for filename in filenames:
+            filename = path.join(self._cache_dir, filename)
+            try:
+                if path.getmtime(filename) < cutoff:
+                    remove(filename)
+            except OSError:
+                pass
+
+    def _discard(self, url):
+        """Remove the entry for a URL from both tiers, if it is there."""
+        entry = self._entries.pop(url, None)
+        if entry:
+            self._size -= entry[3]
+        if self._cache_dir:
+            self._remove_from_disk(url)
+
+    def _store(self, url, text, expires, etag):
+        """Put an entry in the memory tier, evicting others as needed."""
+        size = len(text.encode("utf8"))
+        if size > self._max_size:
+            return
+        old = self._entries.pop(url, None)
+        if old:
+            self._size -= old[3]
+        self._entries[url] = (text, expires, etag, size)
+        self._size += size
+        while self._size > self._max_size:
+            self._size -= self._entries.popitem(last=False)[1][3]
+
+    def _lookup(self, url):
+        """Return the entry for the given URL from either tier, or None."""
+        entry = self._entries.pop(url, None)
+        if entry:
+            self._entries[url] = entry  # Mark as most recently used
+            return entry
+        if self._cache_dir:
+            entry = self._load_from_disk(url)
+            if entry:
+                self._store(url, *entry)
+        return entry
+
+    def get(self, url):
+        """Look up the text of the given URL.
+
+        Returns a 2-tuple of the text and an ETag. If the text is still fresh,
+        it is returned with an ETag of ``None``. Otherwise, the text is
+        ``None``, and the ETag is the one the stale text was served with, if
+        any; it can be sent in an ``If-None-Match`` header, and if the server
+        replies that the text hasn't changed, :py:meth:`revalidate` should be
+        called.
+        """
+        with self._lock:
+            entry = self._lookup(url)
+            if not entry:
+                return None, None
+            text, expires, etag = entry[:3]
+            if expires > time():
+                return text, None
+            if etag:
+                return None, etag
+            self._discard(url)
+            return None, None
+
+    def set(self, url, text, headers):
+        """Store the parsed text of a URL, using its response *headers*.
+
+        Nothing is stored if the response forbids it, or if it has already
+        expired and there is no ETag to revalidate it with later.
+        """
+        expires = self._get_expiry(headers)
+        etag = headers.get("ETag")
+        if expires is None or (expires <= time() and not etag):
+            return
+        with self._lock:
+            self._store(url, text, expires, etag)
+            if self._cache_dir:
+                self._save_to_disk(url, (text, expires, etag))
+                if time() >= self._next_prune:
+                    self._prune_disk()
+
+    def revalidate(self, url, headers):
+        """Mark a stale text as fresh again after a "304 Not Modified".
+
+        *headers* are those of the 304 response. The cached text is returned,
+        or ``None`` if it was evicted in the meantime.
+        """
+        with self._lock:
+            entry = self._lookup(url)
+            if not entry:
+                return None
+            text, etag = entry[0], headers.get("ETag") or entry[2]
+            expires = self._get_expiry(headers)
+            if expires is None:
+                expires = time()
+            self._store(url, text, expires, etag)
+            if self._cache_dir:
+                self._save_to_disk(url, (text, expires, etag))
+            return text
+
+    def prune(self):
+        """Delete long-expired texts from the disk tier of the cache.
+
+        This is done automatically every *ttl* seconds while texts are being
+        stored, but can be called to clean up a cache directory right away.
+        """
+        if self._cache_dir:
+            with self._lock:
+                self._prune_disk()
+
+    def clear(self):
+        """Remove all sources from the memory tier of the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class ResultCache(object):
+    """
+    **EarwigBot: Wiki Toolset: Copyvio Result Cache**
+
+    Stores the results of copyvio checks in a SQLite database (*dbfile*),
+    keyed by site name, page ID, and revision ID, so that a revision that was
+    already checked doesn't have to be searched for again. Results are kept
+    for *expiry* seconds (three days by default). Pass an instance as the
+    *cache* argument of :py:meth:`.CopyvioMixIn.copyvio_check` to use it.
+
+    Only the outcome of each check is stored (see
+    :py:meth:`.CopyvioCheckResult.serialize`), not the text of the article or
+    its sources.
+    """
+
+    def __init__(self, dbfile, expiry=3 * 24 * 60 * 60):
+        self._dbfile = dbfile
+        self._expiry = expiry
+        self._db_access_lock = Lock()
+
+    def __repr__(self):
+        """Return the canonical string representation of the ResultCache."""
+        res = "ResultCache(dbfile={0!r}, expiry={1!r})"
+        return res.format(self._dbfile, self._expiry)
+
+    def __str__(self):
+        """Return a nice string representation of the ResultCache."""
+        return "<ResultCache at {0}>".format(self._dbfile)
+
+    def _connect(self):
+        """Return a connection to the database, creating it if needed."""
+        conn = sqlite.connect(self._dbfile)
+        conn.execute("""CREATE TABLE IF NOT EXISTS results (
+            result_sitename, result_pageid, result_revid, result_url,
+            result_confidence, result_queries, result_time, result_data,
+            PRIMARY KEY (result_sitename, result_pageid, result_revid))""")
+        return conn
+
+    def get(self, sitename, pageid, revid):
+        """Return a cached result for the given page revision, or ``None``.
+
+        The result's :py:attr:`~.CopyvioCheckResult.cached` attribute is set
+        and its sources have empty chains. Expired results are ignored.
+        """
+        query = """SELECT result_data FROM results WHERE result_sitename = ?
+                   AND result_pageid = ? AND result_revid = ?
+                   AND result_time > ?"""
+        args = (sitename, pageid, revid, time() - self._expiry)
+        with self._db_access_lock, self._connect() as conn:
+            row = conn.execute(query, args).fetchone()
+        if not row:
+            return None
+        result = CopyvioCheckResult.unserialize(row[0])
+        result.cached = True
+        return result
+
+    def set(self, sitename, pageid, revid, result):
+        """Store a copyvio check result for the given page revision.
+
+        Expired results are also removed from the database.
+        """
+        query1 = "DELETE FROM results WHERE result_time <= ?"
+        query2 = "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        args = (sitename, pageid, revid, result.url, result.confidence,
+                result.queries, time(), result.serialize())
+        with self._db_access_lock, self._connect() as conn:
+            conn.execute(query1, (time() - self._expiry,))
+            conn.execute(query2, args)
+
+
+class QueryCache(object):
+    """
+    **EarwigBot: Wiki Toolset: Search Query Cache**
+
+    Stores the URLs returned by search engine queries in a SQLite database
+    (*dbfile*), so that sentences searched for again (in re-checks, or in
+    boilerplate shared by many articles) don't cost another API call. Results
+    are kept for *ttl* seconds (a week by default), and the oldest ones are
+    removed once there are more than *max_entries*. Queries are keyed by
+    search engine name and normalized query text.
+
+    Expired and excess queries are removed every :py:attr:`TRIM_INTERVAL`
+    writes, so the table may briefly hold a few more than *max_entries*.
+
+    Use :py:class:`~.CachedSearchEngine` to wrap a search engine with a cache.
+    """
+    TRIM_INTERVAL = 100
+
+    def __init__(self, dbfile, ttl=7 * 24 * 60 * 60, max_entries=100000):
+        self._dbfile = dbfile
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._db_access_lock = Lock()
+        self._writes = 0
+
+    def __repr__(self):
+        """Return the canonical string representation of the QueryCache."""
+        res = "QueryCache(dbfile={0!r}, ttl={1!r}, max_entries={2!r})"
+        return res.format(self._dbfile, self._ttl, self._max_entries)
+
+    def __str__(self):
+        """Return a nice string representation of the QueryCache."""
+        return "<QueryCache at {0}>".format(self._dbfile)
+
+    def _connect(self):
+        """Return a connection to the database, creating it if needed."""
+        conn = sqlite.connect(self._dbfile)
+        conn.execute("""CREATE TABLE IF NOT EXISTS queries (
+            query_engine, query_text, query_urls, query_time,
+            PRIMARY KEY (query_engine, query_text))""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS queries_time
+            ON queries (query_time)""")
+        return conn
+
+    @staticmethod
+    def normalize(query):
+        """Return a normalized form of a query, used as its key."""
+        return u" ".join(query.lower().split())
+
+    def get(self, engine, query):
+        """Return the cached list of URLs for a query, or ``None``.
+
+        *engine* is the name of the search engine that would run the query.
+        """
+        sql = """SELECT query_urls FROM queries WHERE query_engine = ?
+                 AND query_text = ? AND query_time > ?"""
+        args = (engine, self.normalize(query), time() - self._ttl)
+        with self._db_access_lock, self._connect() as conn:
+            row = conn.execute(sql, args).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, engine, query, urls):
+        """Store the list of URLs a search engine returned for a query.
+
+        Every :py:attr:`TRIM_INTERVAL` writes (starting with the first),
+        expired queries are removed, as are the oldest ones beyond our limit.
+        """
+        sql = "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)"
+        args = (engine, self.normalize(query), json.dumps(urls), time())
+        with self._db_access_lock, self._connect() as conn:
+            conn.execute(sql, args)
+            if self._writes % self.TRIM_INTERVAL == 0:
+                self._trim(conn)
+            self._writes += 1
+
+    def _trim(self, conn):
+        """Remove expired queries, and the oldest ones beyond our limit."""
+        sql1 = "DELETE FROM queries WHERE query_time <= ?"
+        sql2 = "SELECT COUNT(*) FROM queries"
+        sql3 = """DELETE FROM queries WHERE rowid IN (
+                  SELECT rowid FROM queries ORDER BY query_time ASC
+                  LIMIT ?)"""
+        conn.execute(sql1, (time() - self._ttl,))
+        count = conn.execute(sql2).fetchone()[0]
+        if count > self._max_entries:
+            conn.execute(sql3, (count - self._max_entries,))
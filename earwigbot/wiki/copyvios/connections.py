@@ -0,0 +1,213 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2009-2015 Ben Kurtovic <ben.kurtovic@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from httplib import HTTPConnection, HTTPException, HTTPSConnection
+import socket
+from threading import Lock
+from time import time
+from urllib2 import addinfourl, HTTPHandler, HTTPSHandler, URLError
+
+__all__ = ["KeepAliveHandler", "resolve"]
+
+_DNS_TTL = 300
+_DNS_MAX_ENTRIES = 1000
+_dns_cache = {}
+_dns_lock = Lock()
+
+def resolve(host, port):
+    """Return a list of socket addresses for a host, using a shared cache.
+
+    Lookups are cached for five minutes, so workers fetching many URLs from
+    the same few domains don't have to resolve them again each time.
+    """
+    key = (host, port)
+    with _dns_lock:
+        entry = _dns_cache.get(key)
+        if entry and entry[1] > time():
+            return entry[0]
+
+    infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    addrs = [(info[0], info[4]) for info in infos]
+    with _dns_lock:
+        if len(_dns_cache) >= _DNS_MAX_ENTRIES:
+            _dns_cache.clear()
+        _dns_cache[key] = (addrs, time() + _DNS_TTL)
+    return addrs
+
+def _get_timeout(timeout):
+    """Return a socket timeout for a request's *timeout*.
+
+    urllib2 passes an opaque default object when no timeout was given; that
+    means the default set with :py:func:`socket.setdefaulttimeout`.
+    """
+    if isinstance(timeout, (int, long, float)):
+        return timeout
+    return socket.getdefaulttimeout()
+
+def _create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                       source_address=None):
+    """Works like socket.create_connection(), but uses our DNS cache."""
+    host, port = address
+    error = None
+    for family, sockaddr in resolve(host, port):
+        sock = None
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(_get_timeout(timeout))
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except socket.error as exc:
+            error = exc
+            if sock:
+                sock.close()
+    raise error or socket.error("getaddrinfo returns an empty list")
+
+
+class KeepAliveHandler(HTTPHandler, HTTPSHandler):
+    """
+    **EarwigBot: Wiki Toolset: Keep-Alive URL Handler**
+
+    A :py:mod:`urllib2` handler for HTTP and HTTPS that keeps connections open
+    between requests, so fetching several URLs from the same host only pays
+    for one TCP (and TLS) handshake. Host names are resolved through
+    :py:func:`resolve`'s cache.
+
+    An open connection is only reused once the previous response on it has
+    been read in full; otherwise, a new one is made. Handlers aren't
+    thread-safe: each :py:class:`~.workers._CopyvioWorker` has its own, and
+    calls :py:meth:`close_all` when it moves on to another domain. The one
+    exception is :py:meth:`abort`, which another thread may call to give up
+    on a request that is taking too long.
+    """
+
+    def __init__(self, debuglevel=0):
+        HTTPHandler.__init__(self, debuglevel)
+        self._connections = {}  # (scheme, host) -> (connection, response)
+        self._abort_lock = Lock()
+        self._aborted = False
+        self._sock = None  # Socket of the request being made, if any
+
+    def _connect(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 source_address=None):
+        """Open a new socket for a connection, unless we were aborted."""
+        sock = _create_connection(address, timeout, source_address)
+        with self._abort_lock:
+            if self._aborted:
+                sock.close()
+                raise socket.error("request aborted")
+            self._sock = sock
+        return sock
+
+    def _track(self, sock):
+        """Set the socket that :py:meth:`abort` should shut down."""
+        with self._abort_lock:
+            self._sock = sock
+
+    def _get_connection(self, key, conn_class, host, timeout):
+        """Return a new or reusable connection, and whether it was reused."""
+        if key in self._connections:
+            conn, last = self._connections.pop(key)
+            if last.isclosed() and conn.sock:
+                conn.timeout = timeout
+                conn.sock.settimeout(_get_timeout(timeout))
+                return conn, True
+            conn.close()
+        conn = conn_class(host, timeout=timeout)
+        conn._create_connection = self._connect
+        conn.set_debuglevel(self._debuglevel)
+        return conn, False
+
+    def _open(self, scheme, conn_class, req):
+        """Make a request using a persistent connection."""
+        host = req.get_host()
+        if not host:
+            raise URLError("no host given")
+        if req._tunnel_host:  # Proxies aren't worth the trouble
+            return self.do_open(conn_class, req)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers["Connection"] = "keep-alive"
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        key = (scheme, host)
+        with self._abort_lock:
+            self._aborted = False
+        while True:
+            conn, reused = self._get_connection(key, conn_class, host,
+                                                req.timeout)
+            if reused:
+                self._track(conn.sock)
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                             headers)
+                response = conn.getresponse(buffering=True)
+            except (HTTPException, socket.error) as exc:
+                conn.close()
+                if reused and not self._aborted:  # Probably closed; retry
+                    continue
+                raise URLError(exc)
+            finally:
+                self._track(None)
+            break
+
+        if not response.will_close:
+            self._connections[key] = (conn, response)
+
+        # Wrap the response the same way urllib2 does:
+        response.recv = response.read
+        fp = socket._fileobject(response, close=True)
+        resp = addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def http_open(self, req):
+        return self._open("http", HTTPConnection, req)
+
+    def https_open(self, req):
+        return self._open("https", HTTPSConnection, req)
+
+    def abort(self):
+        """Interrupt the request being made, from another thread.
+
+        The request's socket is shut down, so whatever is blocking on it
+        (connecting, sending, or waiting for the response's headers) fails
+        with a :py:exc:`~urllib2.URLError`. This has no effect on the body of
+        a response that was already returned.
+        """
+        with self._abort_lock:
+            self._aborted = True
+            if self._sock:
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def close_all(self):
+        """Close all of the connections we are keeping open."""
+        for conn, _ in self._connections.itervalues():
+            conn.close()
+        self._connections.clear()
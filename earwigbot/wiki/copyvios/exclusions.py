@@ -26,10 +26,10 @@ from threading import Lock
 from time import time
 from urlparse import urlparse
 
-from earwigbot import exceptions
-
 __all__ = ["ExclusionsDB"]
 
+_NORMALIZE = re.compile(r"^https?://(www\.)?")
+
 DEFAULT_SOURCES = {
     "all": [  # Applies to all, but located on enwiki
         "User:EarwigBot/Copyvios/Exclusions",
@@ -43,12 +43,130 @@ DEFAULT_SOURCES = {
     ]
 }
 
+class _ExclusionsMatcher(object):
+    """A compiled set of exclusions, to check URLs against quickly.
+
+    There are three kinds of exclusions: ``*.example.com`` matches that
+    domain and its subdomains (optionally followed by a path prefix), and is
+    stored in a trie of reversed domain labels; ``re:`` exclusions are
+    regular expressions matched against the normalized URL, and are combined
+    into as few compiled patterns as possible; anything else is a prefix of
+    the normalized URL, stored in a character trie.
+    """
+    MAX_GROUPS = 99  # Python's re module supports at most 100 groups
+
+    def __init__(self, exclusions):
+        self._domains = {}
+        self._prefixes = {}
+        self._regexes = []
+
+        patterns = []
+        for excl in exclusions:
+            if excl.startswith("*."):
+                self._add_domain(excl[2:])
+            elif excl.startswith("re:"):
+                patterns.append(excl[3:])
+            elif excl:
+                self._add_prefix(excl)
+        self._compile_regexes(patterns)
+
+    def _add_domain(self, excl):
+        """Add a ``*.`` exclusion (without the ``*.``) to the domain trie."""
+        domain, _, path = excl.partition("/")
+        node = self._domains
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        node.setdefault(None, []).append(path)
+
+    def _add_prefix(self, excl):
+        """Add a URL prefix exclusion to the prefix trie."""
+        node = self._prefixes
+        for char in excl:
+            node = node.setdefault(char, {})
+        node[None] = True
+
+    def _compile_regexes(self, patterns):
+        """Compile ``re:`` exclusions into a few large regular expressions.
+
+        Invalid patterns are ignored. Patterns that can't be safely combined
+        with others (because they use backreferences, named groups, or global
+        flags) are compiled on their own.
+        """
+        unsafe = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?[aiLmsux]+\)")
+        batch, groups = [], 0
+        for pattern in patterns:
+            try:
+                regex = re.compile(pattern)
+            except (re.error, AssertionError):
+                continue
+            if unsafe.search(pattern):
+                self._regexes.append(regex)
+                continue
+            if batch and groups + regex.groups > self.MAX_GROUPS:
+                self._add_batch(batch)
+                batch, groups = [], 0
+            batch.append(pattern)
+            groups += regex.groups
+        if batch:
+            self._add_batch(batch)
+
+    def _add_batch(self, patterns):
+        """Compile a list of patterns as one regular expression."""
+        combined = u"|".join(u"(?:{0})".format(pattern)
+                             for pattern in patterns)
+        try:
+            self._regexes.append(re.compile(combined))
+        except (re.error, AssertionError):
+            self._regexes.extend(re.compile(pattern) for pattern in patterns)
+
+    def _match_domain(self, url):
+        """Return whether the URL matches one of the ``*.`` exclusions."""
+        parsed = urlparse(url)
+        node = self._domains
+        for label in reversed((parsed.hostname or "").split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if None in node:
+                path = parsed.path.lstrip("/")
+                if any(path.startswith(prefix) for prefix in node[None]):
+                    return True
+        return False
+
+    def _match_prefix(self, normalized):
+        """Return whether the URL starts with one of the plain exclusions."""
+        node = self._prefixes
+        for char in normalized:
+            node = node.get(char)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def match(self, url, normalized):
+        """Return whether the URL matches one of the exclusions.
+
+        *url* is the lowercased URL, and *normalized* is the same without
+        its scheme and ``www.``.
+        """
+        if self._domains and self._match_domain(url):
+            return True
+        if self._prefixes and self._match_prefix(normalized):
+            return True
+        return any(regex.match(normalized) for regex in self._regexes)
+
+
 class ExclusionsDB(object):
     """
     **EarwigBot: Wiki Toolset: Exclusions Database Manager**
 
     Controls the :file:`exclusions.db` file, which stores URLs excluded from
     copyright violation checks on account of being known mirrors, for example.
+
+    URLs are checked against an in-memory copy of each site's exclusions,
+    which is compiled when the site is first checked and whenever it is
+    :py:meth:`sync`\ ed.
     """
 
     def __init__(self, sitesdb, dbfile, logger):
@@ -56,6 +174,7 @@ class ExclusionsDB(object):
         self._dbfile = dbfile
         self._logger = logger
         self._db_access_lock = Lock()
+        self._matchers = {}
 
     def __repr__(self):
         """Return the canonical string representation of the ExclusionsDB."""
@@ -69,11 +188,12 @@ class ExclusionsDB(object):
     def _create(self):
         """Initialize the exclusions database with its necessary tables."""
         script = """
-            CREATE TABLE sources (source_sitename, source_page);
+            CREATE TABLE sources (source_sitename, source_page, source_revid);
             CREATE TABLE updates (update_sitename, update_time);
-            CREATE TABLE exclusions (exclusion_sitename, exclusion_url);
+            CREATE TABLE exclusions (exclusion_sitename, exclusion_url,
+                                     exclusion_source);
         """
-        query = "INSERT INTO sources VALUES (?, ?);"
+        query = "INSERT INTO sources VALUES (?, ?, NULL);"
         sources = []
         for sitename, pages in DEFAULT_SOURCES.iteritems():
             for page in pages:
@@ -83,14 +203,42 @@ class ExclusionsDB(object):
             conn.executescript(script)
             conn.executemany(query, sources)
 
-    def _load_source(self, site, source):
-        """Load from a specific source and return a set of URLs."""
-        urls = set()
-        try:
-            data = site.get_page(source).get()
-        except exceptions.PageNotFoundError:
-            return urls
+    def _migrate(self, conn):
+        """Add columns missing from databases made by older versions.
 
+        Existing sources get no revision ID, so they will all be reloaded.
+        """
+        tables = [("sources", "source_revid"),
+                  ("exclusions", "exclusion_source")]
+        for table, column in tables:
+            info = conn.execute("PRAGMA table_info({0})".format(table))
+            if column not in [row[1] for row in info]:
+                conn.execute("ALTER TABLE {0} ADD COLUMN {1}".format(
+                    table, column))
+
+    def _get_source_revisions(self, site, sources):
+        """Return a dict mapping source pages to their current revision IDs.
+
+        Pages are queried in batches of 50. Sources that don't exist have a
+        revision ID of 0.
+        """
+        revids = {}
+        for i in xrange(0, len(sources), 50):
+            batch = sources[i:i + 50]
+            result = site.api_query(action="query", prop="info",
+                                    titles="|".join(batch))
+            query = result.get("query", {})
+            titles = dict((title, title) for title in batch)
+            for norm in query.get("normalized", []):
+                titles[norm["to"]] = norm["from"]
+            for page in query.get("pages", {}).itervalues():
+                source = titles.get(page["title"], page["title"])
+                revids[source] = page.get("lastrevid", 0)
+        return revids
+
+    def _parse_source(self, source, data):
+        """Parse the text of a specific source and return a set of URLs."""
+        urls = set()
         if source == "User:EranBot/Copyright/Blacklist":
             for line in data.splitlines()[1:]:
                 line = re.sub(r"(#|==).*$", "", line).strip()
@@ -108,34 +256,97 @@ class ExclusionsDB(object):
                     urls.add(url.lower().strip())
         return urls
 
+    def _fetch_changed(self, site, known):
+        """Fetch and parse the sources that changed since we last loaded them.
+
+        *known* is a dict mapping source pages to the revision IDs we have.
+        All current revision IDs are checked with one query, and then the
+        content of changed sources is loaded in batches. Returns a dict
+        mapping changed sources to (revision ID, set of URLs) tuples.
+        """
+        current = self._get_source_revisions(site, known.keys())
+        changed = [source for source in known
+                   if current.get(source, 0) != known[source]]
+        revids = [current[source] for source in changed if current.get(source)]
+        contents = {}
+        for revision in site.get_revisions(revids, "content"):
+            if revision and "*" in revision:
+                contents[revision["revid"]] = revision["*"]
+
+        updates = {}
+        for source in changed:
+            revid = current.get(source, 0)
+            if not revid:
+                updates[source] = (0, set())
+            elif revid in contents:
+                urls = self._parse_source(source, contents[revid])
+                updates[source] = (revid, urls)
+        return updates
+
     def _update(self, sitename):
-        """Update the database from listed sources in the index."""
-        query1 = "SELECT source_page FROM sources WHERE source_sitename = ?"
-        query2 = "SELECT exclusion_url FROM exclusions WHERE exclusion_sitename = ?"
-        query3 = "DELETE FROM exclusions WHERE exclusion_sitename = ? AND exclusion_url = ?"
-        query4 = "INSERT INTO exclusions VALUES (?, ?)"
-        query5 = "SELECT 1 FROM updates WHERE update_sitename = ?"
-        query6 = "UPDATE updates SET update_time = ? WHERE update_sitename = ?"
-        query7 = "INSERT INTO updates VALUES (?, ?)"
+        """Update the database from listed sources in the index.
+
+        Only sources that have been edited since they were last loaded are
+        fetched again. Network requests are made without holding the database
+        lock, and changes are written in a single transaction. Returns
+        whether any exclusions could have changed.
+        """
+        query1 = "SELECT source_page, source_revid FROM sources WHERE source_sitename = ?"
+        query2 = "DELETE FROM exclusions WHERE exclusion_sitename = ? AND exclusion_source = ?"
+        query3 = "INSERT INTO exclusions VALUES (?, ?, ?)"
+        query4 = "UPDATE sources SET source_revid = ? WHERE source_sitename = ? AND source_page = ?"
+        query5 = """DELETE FROM exclusions WHERE exclusion_sitename = ? AND (
+                    exclusion_source IS NULL OR exclusion_source NOT IN (
+                    SELECT source_page FROM sources WHERE source_sitename = ?))"""
+        query6 = "SELECT 1 FROM updates WHERE update_sitename = ?"
+        query7 = "UPDATE updates SET update_time = ? WHERE update_sitename = ?"
+        query8 = "INSERT INTO updates VALUES (?, ?)"
 
         if sitename == "all":
             site = self._sitesdb.get_site("enwiki")
         else:
             site = self._sitesdb.get_site(sitename)
         with sqlite.connect(self._dbfile) as conn, self._db_access_lock:
-            urls = set()
-            for (source,) in conn.execute(query1, (sitename,)):
-                urls |= self._load_source(site, source)
-            for (url,) in conn.execute(query2, (sitename,)):
-                if url in urls:
-                    urls.remove(url)
-                else:
-                    conn.execute(query3, (sitename, url))
-            conn.executemany(query4, [(sitename, url) for url in urls])
-            if conn.execute(query5, (sitename,)).fetchone():
-                conn.execute(query6, (int(time()), sitename))
+            self._migrate(conn)
+            known = dict(conn.execute(query1, (sitename,)).fetchall())
+
+        updates = self._fetch_changed(site, known)
+        log = u"Reloading {0} of {1} exclusion sources for {2}"
+        self._logger.debug(log.format(len(updates), len(known), sitename))
+
+        with sqlite.connect(self._dbfile) as conn, self._db_access_lock:
+            for source, (revid, urls) in updates.iteritems():
+                conn.execute(query2, (sitename, source))
+                conn.executemany(query3, [(sitename, url, source)
+                                          for url in urls])
+                conn.execute(query4, (revid, sitename, source))
+            removed = conn.execute(query5, (sitename, sitename)).rowcount
+            if conn.execute(query6, (sitename,)).fetchone():
+                conn.execute(query7, (int(time()), sitename))
             else:
-                conn.execute(query7, (sitename, int(time())))
+                conn.execute(query8, (sitename, int(time())))
+        return bool(updates or removed)
+
+    def _load_matcher(self, sitename):
+        """Compile the exclusions for a site into a matcher, and return it.
+
+        The new matcher replaces the old one in a single step, so concurrent
+        :py:meth:`check`\ s see either the old exclusions or the new ones.
+        """
+        query = """SELECT DISTINCT exclusion_url FROM exclusions
+                   WHERE exclusion_sitename = ?"""
+        with sqlite.connect(self._dbfile) as conn, self._db_access_lock:
+            exclusions = [excl for (excl,) in conn.execute(query, (sitename,))]
+        matcher = _ExclusionsMatcher(exclusions)
+        self._matchers[sitename] = matcher
+        return matcher
+
+    def _get_matcher(self, sitename):
+        """Return a site's compiled exclusions, loading them if needed."""
+        matcher = self._matchers.get(sitename)
+        if matcher is None:
+            matcher = self._load_matcher(sitename)
+        return matcher
 
     def _get_last_update(self, sitename):
         """Return the UNIX timestamp of the last time the db was updated."""
@@ -149,19 +360,23 @@ class ExclusionsDB(object):
             return result[0] if result else 0
 
     def sync(self, sitename, force=False):
-        """Update the database if it hasn't been updated in the past day.
+        """Update the database if it hasn't been updated in the past hour.
 
         This updates the exclusions database for the site *sitename* and "all".
+        An update only reloads sources that have been edited since the last
+        one, so it is usually a single API query.
         """
-        max_staleness = 60 * 60 * 24
+        max_staleness = 60 * 60
         time_since_update = int(time() - self._get_last_update(sitename))
         if force or time_since_update > max_staleness:
             log = u"Updating stale database: {0} (last updated {1} seconds ago)"
             self._logger.info(log.format(sitename, time_since_update))
-            self._update(sitename)
+            if self._update(sitename) or sitename not in self._matchers:
+                self._load_matcher(sitename)
         else:
             log = u"Database for {0} is still fresh (last updated {1} seconds ago)"
             self._logger.debug(log.format(sitename, time_since_update))
+            self._get_matcher(sitename)
         if sitename != "all":
             self.sync("all", force=force)
 
@@ -170,28 +385,13 @@ class ExclusionsDB(object):
 
         Return ``True`` if the URL is in the database, or ``False`` otherwise.
         """
-        normalized = re.sub(r"^https?://(www\.)?", "", url.lower())
-        query = """SELECT exclusion_url FROM exclusions
-                   WHERE exclusion_sitename = ? OR exclusion_sitename = ?"""
-        with sqlite.connect(self._dbfile) as conn, self._db_access_lock:
-            for (excl,) in conn.execute(query, (sitename, "all")):
-                if excl.startswith("*."):
-                    parsed = urlparse(url.lower())
-                    matches = excl[2:] in parsed.netloc
-                    if matches and "/" in excl:
-                        excl_path = excl[excl.index("/") + 1]
-                        matches = excl_path.startswith(parsed.path)
-                elif excl.startswith("re:"):
-                    try:
-                        matches = re.match(excl[3:], normalized)
-                    except re.error:
-                        continue
-                else:
-                    matches = normalized.startswith(excl)
-                if matches:
-                    log = u"Exclusion detected in {0} for {1}"
-                    self._logger.debug(log.format(sitename, url))
-                    return True
+        lowered = url.lower()
+        normalized = _NORMALIZE.sub("", lowered)
+        for name in (sitename, "all"):
+            if self._get_matcher(name).match(lowered, normalized):
+                log = u"Exclusion detected in {0} for {1}"
+                self._logger.debug(log.format(name, url))
+                return True
 
         log = u"No exclusions in {0} for {1}".format(sitename, url)
         self._logger.debug(log)
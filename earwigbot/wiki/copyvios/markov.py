@@ -20,22 +20,110 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
+from difflib import SequenceMatcher
+from itertools import islice, izip
 from re import sub, UNICODE
 
-__all__ = ["EMPTY", "EMPTY_INTERSECTION", "MarkovChain",
+from earwigbot import importer
+
+numpy = importer.new("numpy")
+
+__all__ = ["EMPTY", "EMPTY_INTERSECTION", "HashedMarkovChain",
+           "HashedMarkovChainIntersection", "MarkovChain",
            "MarkovChainIntersection"]
 
+def _tokenize(text):
+    """Split text into a list of lowercase words, ignoring punctuation."""
+    return sub("[^\w\s-]", "", text.lower(), flags=UNICODE).split()
+
+def _get_ngram_changes(old_text, new_text, degree, start, end):
+    """Return the ngrams removed and added when going from one text to another.
+
+    The texts are compared paragraph by paragraph (which is cheap, since most
+    paragraphs are unchanged between revisions of an article), and only the
+    ngrams touching a changed paragraph are returned: every other ngram
+    appears in both texts. Two lists of ngram tuples are returned, which are
+    padded with *start* and *end* like the chains themselves.
+
+    Only the changed paragraphs, and just enough of their neighbors to give
+    the ngrams on their edges, are tokenized, so the cost of this depends on
+    the size of the change rather than the size of the texts.
+    """
+    padding = degree - 1
+
+    def get_words(paras, cache, i):
+        if i not in cache:
+            cache[i] = _tokenize(paras[i])
+        return cache[i]
+
+    def count_words(paras, cache, first, last, limit):
+        """Count the words in paragraphs [first, last), up to *limit*."""
+        count = 0
+        for i in xrange(first, last):
+            count += len(get_words(paras, cache, i))
+            if count >= limit:
+                break
+        return count
+
+    def get_ngrams(paras, cache, first, last):
+        """Return the ngrams touching words in paragraphs [first, last)."""
+        before = []
+        i = first - 1
+        while len(before) < padding and i >= 0:
+            before = get_words(paras, cache, i) + before
+            i -= 1
+        before = ([start] * padding + before)[-padding:] if padding else []
+        after = []
+        i = last
+        while len(after) < padding and i < len(paras):
+            after.extend(get_words(paras, cache, i))
+            i += 1
+        after = (after + [end] * padding)[:padding]
+
+        words = list(before)
+        for i in xrange(first, last):
+            words.extend(get_words(paras, cache, i))
+        words.extend(after)
+        return [tuple(words[k:k + degree])
+                for k in xrange(len(words) - padding)]
+
+    old_paras, new_paras = old_text.split("\n"), new_text.split("\n")
+    old_cache, new_cache = {}, {}
+
+    # Changed regions separated by fewer than *padding* words share some
+    # ngrams, so they are merged to avoid counting those twice:
+    regions = []
+    matcher = SequenceMatcher(None, old_paras, new_paras, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        if regions:
+            p1, p2, q1, q2 = regions[-1]
+            if count_words(old_paras, old_cache, p2, i1, padding) < padding:
+                regions[-1] = (p1, i2, q1, j2)
+                continue
+        regions.append((i1, i2, j1, j2))
+
+    removed, added = [], []
+    for i1, i2, j1, j2 in regions:
+        removed.extend(get_ngrams(old_paras, old_cache, i1, i2))
+        added.extend(get_ngrams(new_paras, new_cache, j1, j2))
+    return removed, added
+
 class MarkovChain(object):
     """Implements a basic ngram Markov chain of words."""
     START = -1
     END = -2
+    MAX_PATCH = 4  # Rebuild instead of patching more than 1/4 of a chain
     degree = 3  # 2 for bigrams, 3 for trigrams, etc.
 
     def __init__(self, text):
         self.text = text
         self.chain = defaultdict(lambda: defaultdict(lambda: 0))
-        words = sub("[^\w\s-]", "", text.lower(), flags=UNICODE).split()
+        words = _tokenize(text)
 
         padding = self.degree - 1
         words = ([self.START] * padding) + words + ([self.END] * padding)
@@ -52,6 +140,51 @@ class MarkovChain(object):
                 size += hits
         return size
 
+    def intersect(self, other):
+        """Return the intersection of this chain with another one."""
+        return MarkovChainIntersection(self, other)
+
+    def patch(self, old_text, new_text):
+        """Return a chain of *new_text*, given that this is one of *old_text*.
+
+        Only ngrams around the paragraphs that differ between the two texts
+        are removed from or added to a copy of this chain, which is much
+        faster than building a new chain when the texts are mostly the same,
+        like two revisions of an article. If more than 1/:py:attr:`MAX_PATCH`
+        of the chain would change, a new chain is built instead.
+        """
+        removed, added = _get_ngram_changes(
+            old_text, new_text, self.degree, self.START, self.END)
+        if (len(removed) + len(added)) * self.MAX_PATCH > self.size:
+            return type(self)(new_text)  # Cheaper to start over
+
+        # The new chain shares the nodes of unchanged prefixes with ours, and
+        # only the ones we modify are copied:
+        new = type(self).__new__(type(self))
+        new.text = new_text
+        new.chain = defaultdict(self.chain.default_factory, self.chain)
+        copied = set()
+
+        def get_nodes(prefix):
+            if prefix not in copied:
+                nodes = defaultdict(lambda: 0, self.chain.get(prefix, ()))
+                new.chain[prefix] = nodes
+                copied.add(prefix)
+            return new.chain[prefix]  # Made empty if we deleted it
+
+        for ngram in removed:
+            prefix, node = ngram[:-1], ngram[-1]
+            nodes = get_nodes(prefix)
+            nodes[node] -= 1
+            if not nodes[node]:
+                del nodes[node]
+                if not nodes:
+                    del new.chain[prefix]
+        for ngram in added:
+            get_nodes(ngram[:-1])[ngram[-1]] += 1
+        new.size = self.size - len(removed) + len(added)
+        return new
+
     def __repr__(self):
         """Return the canonical string representation of the MarkovChain."""
         return "MarkovChain(text={0!r})".format(self.text)
@@ -90,5 +223,152 @@ class MarkovChainIntersection(MarkovChain):
         return res.format(self.size, self.mc1, self.mc2)
 
 
+class HashedMarkovChain(object):
+    """Implements a compact ngram Markov chain of words.
+
+    This gives the same sizes (and therefore the same confidences) as
+    :py:class:`MarkovChain`, but instead of nested dicts of word tuples, each
+    ngram is stored as a 64-bit hash in a sorted array, with its count in a
+    parallel array. The text itself is not kept. This uses far less memory
+    and is much faster to build, but the chain can't be used to find out
+    which words are shared, e.g. for highlighting.
+    """
+    START = MarkovChain.START
+    END = MarkovChain.END
+    MAX_PATCH = MarkovChain.MAX_PATCH
+    degree = MarkovChain.degree
+    HASH_TYPE = "l"  # Python's hashes are native signed longs
+    COUNT_TYPE = "I"
+
+    def __init__(self, text):
+        words = _tokenize(text)
+        padding = self.degree - 1
+        words = ([self.START] * padding) + words + ([self.END] * padding)
+
+        # zip() builds the ngram tuples without a Python-level loop:
+        ngrams = zip(*[words[i:] for i in xrange(self.degree)])
+        hashes = sorted(map(hash, ngrams))
+        self.hashes = array(self.HASH_TYPE, sorted(set(hashes)))
+        self.counts = array(self.COUNT_TYPE, [1]) * len(self.hashes)
+
+        # Repeated ngrams are relatively rare, so count them individually:
+        repeats = [h1 for h1, h2 in izip(hashes, islice(hashes, 1, None))
+                   if h1 == h2]
+        for ngram in repeats:
+            self.counts[bisect_left(self.hashes, ngram)] += 1
+        self.size = len(hashes)
+
+    def intersect(self, other):
+        """Return the intersection of this chain with another one."""
+        return HashedMarkovChainIntersection(self, other)
+
+    def patch(self, old_text, new_text):
+        """Return a chain of *new_text*, given that this is one of *old_text*.
+
+        This works like :py:meth:`MarkovChain.patch`. The new arrays are
+        made in one pass, copying the runs of our arrays between changed
+        ngrams and merging in the changes.
+        """
+        removed, added = _get_ngram_changes(
+            old_text, new_text, self.degree, self.START, self.END)
+        if (len(removed) + len(added)) * self.MAX_PATCH > self.size:
+            return type(self)(new_text)  # Cheaper to start over
+
+        changes = defaultdict(int)
+        for ngram in removed:
+            changes[hash(ngram)] -= 1
+        for ngram in added:
+            changes[hash(ngram)] += 1
+
+        new = type(self).__new__(type(self))
+        new.hashes = array(self.HASH_TYPE)
+        new.counts = array(self.COUNT_TYPE)
+        last = 0
+        for ngram, change in sorted(changes.iteritems()):
+            if not change:
+                continue
+            i = bisect_left(self.hashes, ngram, last)
+            new.hashes.extend(self.hashes[last:i])
+            new.counts.extend(self.counts[last:i])
+            if i < len(self.hashes) and self.hashes[i] == ngram:
+                count = self.counts[i] + change
+                last = i + 1
+            else:
+                count = change
+                last = i
+            if count > 0:
+                new.hashes.append(ngram)
+                new.counts.append(count)
+        new.hashes.extend(self.hashes[last:])
+        new.counts.extend(self.counts[last:])
+        new.size = self.size - len(removed) + len(added)
+        return new
+
+    def __repr__(self):
+        """Return the canonical string representation of the chain."""
+        return "HashedMarkovChain(size={0!r})".format(self.size)
+
+    def __str__(self):
+        """Return a nice string representation of the chain."""
+        return "<HashedMarkovChain of size {0}>".format(self.size)
+
+
+class HashedMarkovChainIntersection(HashedMarkovChain):
+    """Implements the intersection of two hashed chains.
+
+    Shared ngrams are found by intersecting the sorted hash arrays, using
+    :py:mod:`numpy` if it's available and falling back on set intersection
+    and binary searches otherwise; both give identical results.
+    """
+
+    def __init__(self, mc1, mc2):
+        self.mc1, self.mc2 = mc1, mc2
+        self.hashes = array(self.HASH_TYPE)
+        self.counts = array(self.COUNT_TYPE)
+        try:
+            self._intersect_numpy(mc1, mc2)
+        except ImportError:
+            self._intersect_python(mc1, mc2)
+        self.size = sum(self.counts)
+
+    def _intersect_numpy(self, mc1, mc2):
+        """Fill in our hashes and counts using vectorized operations."""
+        htype, ctype = numpy.dtype(self.HASH_TYPE), numpy.dtype(self.COUNT_TYPE)
+        hashes1 = numpy.frombuffer(mc1.hashes, dtype=htype)
+        hashes2 = numpy.frombuffer(mc2.hashes, dtype=htype)
+        common = numpy.intersect1d(hashes1, hashes2, assume_unique=True)
+        if not len(common):
+            return
+        counts1 = numpy.frombuffer(mc1.counts, dtype=ctype)
+        counts2 = numpy.frombuffer(mc2.counts, dtype=ctype)
+        counts = numpy.minimum(counts1[hashes1.searchsorted(common)],
+                               counts2[hashes2.searchsorted(common)])
+        self.hashes.fromstring(common.tostring())
+        self.counts.fromstring(counts.astype(ctype).tostring())
+
+    def _intersect_python(self, mc1, mc2):
+        """Fill in our hashes and counts without numpy.
+
+        The set intersection runs in C; only the (usually few) shared ngrams
+        are visited in Python, each with a binary search into both arrays.
+        """
+        hashes1, hashes2 = mc1.hashes, mc2.hashes
+        for ngram in sorted(set(hashes1).intersection(hashes2)):
+            count1 = mc1.counts[bisect_left(hashes1, ngram)]
+            count2 = mc2.counts[bisect_left(hashes2, ngram)]
+            self.hashes.append(ngram)
+            self.counts.append(min(count1, count2))
+
+    def __repr__(self):
+        """Return the canonical string representation of the intersection."""
+        res = "HashedMarkovChainIntersection(mc1={0!r}, mc2={1!r})"
+        return res.format(self.mc1, self.mc2)
+
+    def __str__(self):
+        """Return a nice string representation of the intersection."""
+        res = "<HashedMarkovChainIntersection of size {0} ({1} ^ {2})>"
+        return res.format(self.size, self.mc1, self.mc2)
+
+
 EMPTY = MarkovChain("")
 EMPTY_INTERSECTION = MarkovChainIntersection(EMPTY, EMPTY)
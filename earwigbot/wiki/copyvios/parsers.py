@@ -20,9 +20,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from bisect import insort
 from os import path
 import re
 from StringIO import StringIO
+from threading import Lock
 
 import mwparserfromhell
 
@@ -42,8 +44,9 @@ class _BaseTextParser(object):
     """Base class for a parser that handles text."""
     TYPE = None
 
-    def __init__(self, text):
+    def __init__(self, text, args=None):
         self.text = text
+        self._args = args or {}
 
     def __repr__(self):
         """Return the canonical string representation of the text parser."""
@@ -56,8 +59,46 @@ class _BaseTextParser(object):
 
 
 class ArticleTextParser(_BaseTextParser):
-    """A parser that can strip and chunk wikicode article text."""
+    """A parser that can strip and chunk wikicode article text.
+
+    The text is only parsed once, even if both :py:meth:`strip` and
+    :py:meth:`get_links` are used. If the caller has already parsed it, the
+    :py:class:`~mwparserfromhell.wikicode.Wikicode` can be given as
+    *wikicode* to avoid parsing it again; note that :py:meth:`strip` modifies
+    it in place.
+    """
     TYPE = "Article"
+    _tokenizers = {}
+    _tokenizer_lock = Lock()
+
+    def __init__(self, text, args=None, wikicode=None):
+        super(ArticleTextParser, self).__init__(text, args)
+        self._wikicode = wikicode
+        self._links = None
+
+    def _get_wikicode(self):
+        """Return the parsed article text, parsing it the first time."""
+        if self._wikicode is None:
+            self._wikicode = mwparserfromhell.parse(self.text)
+        return self._wikicode
+
+    @classmethod
+    def _get_tokenizer(cls, nltk_dir):
+        """Return nltk's sentence tokenizer, loading it only the first time.
+
+        The tokenizer is shared by all parsers in the process, so its data
+        file is only read from disk (and downloaded, if missing) once.
+        """
+        datafile = path.join(nltk_dir, "tokenizers", "punkt", "english.pickle")
+        with cls._tokenizer_lock:
+            if datafile not in cls._tokenizers:
+                try:
+                    tokenizer = nltk.data.load("file:" + datafile)
+                except LookupError:
+                    nltk.download("punkt", nltk_dir)
+                    tokenizer = nltk.data.load("file:" + datafile)
+                cls._tokenizers[datafile] = tokenizer
+            return cls._tokenizers[datafile]
 
     def strip(self):
         """Clean the page's raw text by removing templates and formatting.
@@ -82,7 +123,9 @@ class ArticleTextParser(_BaseTextParser):
             except ValueError:
                 pass
 
-        wikicode = mwparserfromhell.parse(self.text)
+        wikicode = self._get_wikicode()
+        if self._links is None:  # Find links before we remove any of them
+            self._links = self._find_links(wikicode)
 
         # Preemtively strip some links mwparser doesn't know about:
         bad_prefixes = ("file:", "image:", "category:")
@@ -112,13 +155,7 @@ class ArticleTextParser(_BaseTextParser):
         directory (*nltk_dir*) is required to store nltk's punctuation
         database. This is typically located in the bot's working directory.
         """
-        datafile = path.join(nltk_dir, "tokenizers", "punkt", "english.pickle")
-        try:
-            tokenizer = nltk.data.load("file:" + datafile)
-        except LookupError:
-            nltk.download("punkt", nltk_dir)
-            tokenizer = nltk.data.load("file:" + datafile)
-
+        tokenizer = self._get_tokenizer(nltk_dir)
         sentences = []
         for sentence in tokenizer.tokenize(self.clean):
             if len(sentence) > max_query:
@@ -133,31 +170,93 @@ class ArticleTextParser(_BaseTextParser):
         if max_chunks >= len(sentences):
             return sentences
 
+        # Take sentences from the beginning, end, Q2, Q1, and Q3 of the ones
+        # that remain, in turn. Instead of removing them from the list, we
+        # keep the (sorted) indices we've taken, and map each position among
+        # the remaining sentences to its index by skipping over those:
         chunks = []
+        taken = []
         while len(chunks) < max_chunks:
-            if len(chunks) % 5 == 0:
-                chunk = sentences.pop(0)  # Pop from beginning
-            elif len(chunks) % 5 == 1:
-                chunk = sentences.pop()  # Pop from end
-            elif len(chunks) % 5 == 2:
-                chunk = sentences.pop(len(sentences) / 2)  # Pop from Q2
-            elif len(chunks) % 5 == 3:
-                chunk = sentences.pop(len(sentences) / 4)  # Pop from Q1
-            else:
-                chunk = sentences.pop(3 * len(sentences) / 4)  # Pop from Q3
-            chunks.append(chunk)
+            remaining = len(sentences) - len(chunks)
+            positions = (0, remaining - 1, remaining / 2, remaining / 4,
+                         3 * remaining / 4)
+            index = positions[len(chunks) % 5]
+            for used in taken:
+                if used > index:
+                    break
+                index += 1
+            insort(taken, index)
+            chunks.append(sentences[index])
         return chunks
 
+    @staticmethod
+    def _find_links(wikicode):
+        """Return a list of the http(s) external links in some wikicode."""
+        schemes = ("http://", "https://")
+        links = wikicode.ifilter_external_links()
+        return [unicode(link.url) for link in links
+                if link.url.startswith(schemes)]
+
     def get_links(self):
         """Return a list of all external links in the article.
 
         The list is restricted to things that we suspect we can parse: i.e.,
-        those with schemes of ``http`` and ``https``.
+        those with schemes of ``http`` and ``https``. Links are found in the
+        same parse of the text used by :py:meth:`strip`, before it removes
+        anything.
         """
-        schemes = ("http://", "https://")
-        links = mwparserfromhell.parse(self.text).ifilter_external_links()
-        return [unicode(link.url) for link in links
-                if link.url.startswith(schemes)]
+        if self._links is None:
+            self._links = self._find_links(self._get_wikicode())
+        return list(self._links)
+
+
+class _HTMLTextTarget(object):
+    """An lxml parser target that collects the visible text of a document.
+
+    Text is gathered in a single pass over the parser's events, without
+    building a tree. The result matches what :py:class:`_HTMLParser` gets
+    from BeautifulSoup: each run of text inside ``<body>`` (split by tags and
+    comments, and outside of hidden tags), stripped, with empty runs dropped.
+    """
+
+    def __init__(self, hidden_tags):
+        self._hidden_tags = hidden_tags
+        self._in_body = False
+        self._hidden = 0
+        self._buffer = []
+        self._strings = []
+
+    def _flush(self):
+        """Finish the current run of text."""
+        if self._buffer:
+            text = u"".join(self._buffer).strip()
+            if text and self._in_body and not self._hidden:
+                self._strings.append(text)
+            self._buffer = []
+
+    def start(self, tag, attrib):
+        self._flush()
+        if tag == "body":
+            self._in_body = True
+        elif tag in self._hidden_tags:
+            self._hidden += 1
+
+    def end(self, tag):
+        self._flush()
+        if tag == "body":
+            self._in_body = False
+        elif tag in self._hidden_tags and self._hidden:
+            self._hidden -= 1
+
+    def data(self, data):
+        self._buffer.append(data)
+
+    def comment(self, text):
+        self._flush()
+
+    def close(self):
+        self._flush()
+        return u"\n".join(self._strings)
 
 
 class _HTMLParser(_BaseTextParser):
@@ -167,12 +266,48 @@ class _HTMLParser(_BaseTextParser):
         "script", "style"
     ]
 
+    def _parse_with_lxml(self):
+        """Return the text of the document using a streaming lxml parser.
+
+        The document is decoded first, detecting its encoding the same way
+        BeautifulSoup does. None is returned if that fails, so the caller can
+        fall back on BeautifulSoup.
+        """
+        # Not loaded lazily like our other dependencies, as that would stop
+        # BeautifulSoup from detecting lxml when it is imported later:
+        from lxml import etree
+
+        text = self.text
+        if isinstance(text, str):
+            text = bs4.UnicodeDammit(text, is_html=True).unicode_markup
+            if text is None:
+                return None
+
+        target = _HTMLTextTarget(self.hidden_tags)
+        parser = etree.HTMLParser(target=target)
+        try:
+            parser.feed(text)
+            return parser.close()
+        except etree.LxmlError:
+            return target.close()
+        except (UnicodeError, ValueError):
+            return None
+
     def parse(self):
         """Return the actual text contained within an HTML document.
 
         Implemented using :py:mod:`BeautifulSoup <bs4>`
-        (http://www.crummy.com/software/BeautifulSoup/).
+        (http://www.crummy.com/software/BeautifulSoup/), unless the
+        *htmlParser* parser argument is ``"lxml"``, in which case we use a
+        much faster streaming :py:mod:`lxml <lxml.etree>` parser that
+        extracts the same text without building a tree (falling back on
+        BeautifulSoup if the document can't be decoded).
         """
+        if self._args.get("htmlParser") == "lxml":
+            text = self._parse_with_lxml()
+            if text is not None:
+                return text
+
         try:
             soup = bs4.BeautifulSoup(self.text, "lxml").body
         except ValueError:
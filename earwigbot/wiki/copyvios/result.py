@@ -20,6 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import json
 from threading import Event
 from time import time
 
@@ -40,17 +41,32 @@ class CopyvioSource(object):
     - :py:attr:`confidence`: the confidence of a violation, between 0 and 1
     - :py:attr:`chains`:     a 2-tuple of the source chain and the delta chain
     - :py:attr:`skipped`:    whether this URL was skipped during the check
+    - :py:attr:`timings`:    a dict of seconds spent on each stage of work
+    - :py:attr:`bytes_read`: the number of bytes downloaded from the URL
+    - :py:attr:`bytes_decoded`: the size of the content after decompression
+
+    The stages in :py:attr:`timings` are ``"queue"`` (waiting for a worker),
+    ``"connect"`` (opening the URL and getting headers), ``"download"``
+    (reading the body, including ``"decompress"``), ``"parse"``,
+    ``"chain"`` (building the source's chain), and ``"compare"``. Stages a
+    source didn't go through (like if it was skipped or cached) are missing.
     """
 
-    def __init__(self, workspace, url, headers=None, timeout=5):
+    def __init__(self, workspace, url, headers=None, timeout=5,
+                 parser_args=None):
         self.workspace = workspace
         self.url = url
         self.headers = headers
         self.timeout = timeout
+        self.parser_args = parser_args
         self.confidence = 0.0
         self.chains = (EMPTY, EMPTY_INTERSECTION)
         self.skipped = False
+        self.timings = {}
+        self.bytes_read = 0
+        self.bytes_decoded = 0
 
+        self._queued = time()
         self._event1 = Event()
         self._event2 = Event()
         self._event2.set()
@@ -69,6 +85,7 @@ class CopyvioSource(object):
 
     def start_work(self):
         """Mark this source as being worked on right now."""
+        self.timings["queue"] = time() - self._queued
         self._event2.clear()
         self._event1.set()
 
@@ -82,11 +99,16 @@ class CopyvioSource(object):
         self._event2.set()
 
     def skip(self):
-        """Deactivate this source without filling in the relevant data."""
+        """Deactivate this source without filling in the relevant data.
+
+        Returns ``True`` if the source was skipped, or ``False`` if it was
+        already being worked on (or skipped).
+        """
         if self._event1.is_set():
-            return
+            return False
         self.skipped = True
         self._event1.set()
+        return True
 
     def join(self, until):
         """Block until this violation result is filled out."""
@@ -114,9 +136,20 @@ class CopyvioCheckResult(object):
     - :py:attr:`confidence`:    the best matching source's confidence, or 0
     - :py:attr:`url`:           the best matching source's URL, or ``None``
     - :py:attr:`queries`:       the number of queries used to reach a result
+    - :py:attr:`cached_queries`: how many of those were answered by a cache
     - :py:attr:`time`:          the amount of time the check took to complete
     - :py:attr:`article_chain`: the MarkovChain of the article text
     - :py:attr:`possible_miss`: whether some URLs might have been missed
+    - :py:attr:`cached`:        whether this result came from a result cache
+    - :py:attr:`timings`:       a dict of seconds spent on each check stage
+    - :py:attr:`bytes_read`:    the number of bytes downloaded from sources
+
+    The stages in :py:attr:`timings` are ``"article"`` (stripping the article
+    and building its chain), ``"exclusions"`` (syncing the exclusions
+    database), ``"chunk"`` (picking queries), ``"search"`` (all queries,
+    with each one's time in ``"queries"``), and ``"wait"`` (waiting for
+    sources after searching is done). Each source has its own timings, which
+    are summed up by :py:meth:`get_source_timings`.
     """
 
     def __init__(self, violation, sources, queries, check_time, article_chain,
@@ -127,6 +160,9 @@ class CopyvioCheckResult(object):
         self.time = check_time
         self.article_chain = article_chain
         self.possible_miss = possible_miss
+        self.cached = False
+        self.cached_queries = 0
+        self.timings = {}
 
     def __repr__(self):
         """Return the canonical string representation of the result."""
@@ -154,12 +190,79 @@ class CopyvioCheckResult(object):
         """The URL of the best source, or None if no sources exist."""
         return self.best.url if self.best else None
 
+    @property
+    def bytes_read(self):
+        """The number of bytes downloaded from all sources during the check."""
+        return sum(source.bytes_read for source in self.sources)
+
+    def get_source_timings(self):
+        """Return a dict of seconds spent on each source stage, summed up.
+
+        Sources are handled in parallel, so these can add up to more than
+        :py:attr:`time`.
+        """
+        totals = {}
+        for source in self.sources:
+            for stage, seconds in source.timings.iteritems():
+                totals[stage] = totals.get(stage, 0) + seconds
+        return totals
+
+    def _get_timing_summary(self):
+        """Return a short summary of this result's timings for logging."""
+        stages = ["article", "exclusions", "chunk", "search", "wait"]
+        check = [u"{0} {1:.2f}s".format(stage, self.timings[stage])
+                 for stage in stages if stage in self.timings]
+        totals = self.get_source_timings()
+        stages = ["queue", "connect", "download", "decompress", "parse",
+                  "chain", "compare"]
+        sources = [u"{0} {1:.2f}s".format(stage, totals[stage])
+                   for stage in stages if stage in totals]
+        if not check and not sources:
+            return u""
+        summary = u"; ".join(check)
+        if sources:
+            summary += u"{0}sources: {1}; {2} bytes read".format(
+                u"; " if check else u"", u", ".join(sources), self.bytes_read)
+        return u" [" + summary + u"]"
+
+    def serialize(self):
+        """Return a compact string representation of this result.
+
+        Only the outcome of the check is kept: source URLs, confidences, and
+        so on, but not the chains. The result can be rebuilt with
+        :py:meth:`unserialize`.
+        """
+        sources = [(source.url, source.confidence, source.skipped)
+                   for source in self.sources]
+        data = [self.violation, sources, self.queries, self.time,
+                self.possible_miss]
+        return json.dumps(data, separators=(",", ":"))
+
+    @classmethod
+    def unserialize(cls, data, article_chain=None):
+        """Rebuild a result from a string made by :py:meth:`serialize`.
+
+        Sources in the new result have empty chains. *article_chain* is used
+        as the result's article chain, if given.
+        """
+        violation, sources, queries, check_time, miss = json.loads(data)
+        objects = []
+        for url, confidence, skipped in sources:
+            source = CopyvioSource(None, url)
+            source.confidence = confidence
+            source.skipped = skipped
+            objects.append(source)
+        return cls(violation, objects, queries, check_time, article_chain,
+                   miss)
+
     def get_log_message(self, title):
         """Build a relevant log message for this copyvio check result."""
         if not self.sources:
-            log = u"No violation for [[{0}]] (no sources; {1} queries; {2} seconds)"
-            return log.format(title, self.queries, self.time)
-        log = u"{0} for [[{1}]] (best: {2} ({3} confidence); {4} sources; {5} queries; {6} seconds)"
+            log = u"No violation for [[{0}]] (no sources; {1} queries; {2} seconds){3}"
+            return log.format(title, self.queries, self.time,
+                              self._get_timing_summary())
+        log = u"{0} for [[{1}]] (best: {2} ({3} confidence); {4} sources; {5} queries; {6} seconds){7}"
         is_vio = "Violation detected" if self.violation else "No violation"
         return log.format(is_vio, title, self.url, self.confidence,
-                          len(self.sources), self.queries, self.time)
+                          len(self.sources), self.queries, self.time,
+                          self._get_timing_summary())
@@ -24,6 +24,8 @@ from gzip import GzipFile
 from json import loads
 from socket import error
 from StringIO import StringIO
+from threading import BoundedSemaphore, Lock
+from time import sleep, time
 from urllib import quote
 from urllib2 import URLError
 
@@ -32,7 +34,11 @@ from earwigbot.exceptions import SearchQueryError
 
 oauth = importer.new("oauth2")
 
-__all__ = ["BaseSearchEngine", "YahooBOSSSearchEngine"]
+__all__ = ["BaseSearchEngine", "CachedSearchEngine", "ThrottledSearchEngine",
+           "YahooBOSSSearchEngine"]
+
+_throttles = {}
+_throttles_lock = Lock()
 
 class BaseSearchEngine(object):
     """Base class for a simple search engine interface."""
@@ -59,6 +65,100 @@ class BaseSearchEngine(object):
         raise NotImplementedError()
 
 
+class CachedSearchEngine(BaseSearchEngine):
+    """A wrapper around another search engine that caches its results.
+
+    Queries are looked up in a :py:class:`~.QueryCache` before being passed on
+    to the real engine. The number of queries answered by the cache and by
+    the engine are counted in :py:attr:`hits` and :py:attr:`misses`.
+    """
+
+    def __init__(self, engine, cache):
+        super(CachedSearchEngine, self).__init__(engine.cred, engine.opener)
+        self.engine = engine
+        self.cache = cache
+        self.name = engine.name
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        """Return the canonical string representation of the search engine."""
+        res = "CachedSearchEngine(engine={0!r}, cache={1!r})"
+        return res.format(self.engine, self.cache)
+
+    def __str__(self):
+        """Return a nice string representation of the search engine."""
+        return "<CachedSearchEngine of {0}>".format(self.engine)
+
+    def search(self, query):
+        """Search for *query*, using a cached result if we have one."""
+        urls = self.cache.get(self.name, query)
+        if urls is not None:
+            self.hits += 1
+            return urls
+        urls = self.engine.search(query)
+        self.misses += 1
+        self.cache.set(self.name, query, urls)
+        return urls
+
+
+class _Throttle(object):
+    """Limits the rate and concurrency of queries made to one engine."""
+
+    def __init__(self, rate, concurrency):
+        self._interval = 1.0 / rate if rate > 0 else 0
+        self._slots = BoundedSemaphore(concurrency)
+        self._lock = Lock()
+        self._next = 0
+
+    def __enter__(self):
+        """Block until a query may be made."""
+        self._slots.acquire()
+        with self._lock:
+            now = time()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            sleep(start - now)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Mark the query as finished."""
+        self._slots.release()
+
+
+class ThrottledSearchEngine(BaseSearchEngine):
+    """A wrapper around another search engine that limits its query rate.
+
+    No more than *rate* queries per second are started, and no more than
+    *concurrency* are run at once. The limits are shared by all wrappers
+    around engines with the same name in the process, so they hold across
+    simultaneous checks; the first wrapper for an engine sets them.
+    """
+
+    def __init__(self, engine, rate=1, concurrency=1):
+        super(ThrottledSearchEngine, self).__init__(engine.cred,
+                                                    engine.opener)
+        self.engine = engine
+        self.name = engine.name
+        with _throttles_lock:
+            if self.name not in _throttles:
+                _throttles[self.name] = _Throttle(rate, concurrency)
+            self._throttle = _throttles[self.name]
+
+    def __repr__(self):
+        """Return the canonical string representation of the search engine."""
+        return "ThrottledSearchEngine(engine={0!r})".format(self.engine)
+
+    def __str__(self):
+        """Return a nice string representation of the search engine."""
+        return "<ThrottledSearchEngine of {0}>".format(self.engine)
+
+    def search(self, query):
+        """Search for *query*, waiting first if we are over our limits."""
+        with self._throttle:
+            return self.engine.search(query)
+
+
 class YahooBOSSSearchEngine(BaseSearchEngine):
     """A search engine interface with Yahoo! BOSS."""
     name = "Yahoo! BOSS"
@@ -20,31 +20,45 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from collections import deque
-from gzip import GzipFile
+from collections import defaultdict, deque, OrderedDict
 from httplib import HTTPException
 from logging import getLogger
 from math import log
-from Queue import Empty, Queue
-from socket import error as socket_error
-from StringIO import StringIO
-from struct import error as struct_error
-from threading import Lock, Thread
+from multiprocessing import Pool, TimeoutError
+from Queue import Empty
+import signal
+from socket import error as socket_error, SHUT_RDWR
+from threading import Condition, Lock, Thread, Timer
 from time import time
-from urllib2 import build_opener, URLError
+from urllib2 import build_opener, HTTPError, Request, URLError
+from weakref import WeakKeyDictionary
+import zlib
 
 from earwigbot import importer
-from earwigbot.wiki.copyvios.markov import MarkovChain, MarkovChainIntersection
+from earwigbot.wiki.copyvios.cache import SourceCache
+from earwigbot.wiki.copyvios.connections import KeepAliveHandler
 from earwigbot.wiki.copyvios.parsers import get_parser
 from earwigbot.wiki.copyvios.result import CopyvioCheckResult, CopyvioSource
 
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
 tldextract = importer.new("tldextract")
 
-__all__ = ["globalize", "localize", "CopyvioWorkspace"]
+__all__ = ["globalize", "localize", "cache_sources", "uncache_sources",
+           "start_parser_pool", "stop_parser_pool", "CopyvioWorkerPool",
+           "CopyvioWorkspace"]
 
 _is_globalized = False
 _global_queues = None
 _global_workers = []
+_source_cache = None
+_parser_pool = None
+_parser_cpu_limit = None
+_default_pool = None
+_default_pool_lock = Lock()
 
 def globalize(num_workers=8):
     """Cause all copyvio checks to be done by one global set of workers.
@@ -82,23 +96,266 @@ def localize():
         return
 
     for i in xrange(len(_global_workers)):
-        _global_queues.unassigned.put((StopIteration, None))
+        _global_queues.stop()
     _global_queues = None
     _global_workers = []
     _is_globalized = False
 
+def cache_sources(ttl=3600, max_size=64 * 1024 ** 2, cache_dir=None):
+    """Cause the parsed text of source URLs to be cached between checks.
+
+    Workers will look for a URL in the cache before fetching it, so sources
+    that come up again and again (like Wikipedia mirrors) are only downloaded
+    and parsed once every *ttl* seconds, or as often as their servers'
+    ``Cache-Control`` and ``ETag`` headers require. Up to *max_size* bytes of
+    text are kept in memory; if *cache_dir* is given, texts are also stored
+    in that directory so they survive restarts. See :class:`.SourceCache`.
+
+    The cache is shared by all checks in the process, whether or not they
+    use :func:`globalize`\ d workers. Calling this again replaces the cache.
+    """
+    global _source_cache
+    _source_cache = SourceCache(ttl, max_size, cache_dir)
+
+def uncache_sources():
+    """Stop caching source URLs, as enabled by :func:`cache_sources`."""
+    global _source_cache
+    _source_cache = None
+
+def start_parser_pool(num_processes=None, cpu_limit=10):
+    """Cause downloaded HTML and PDF sources to be parsed in child processes.
+
+    Parsing is mostly pure Python that holds the GIL, so worker threads can't
+    parse more than one document at a time between them; this spreads the
+    work across *num_processes* processes instead (by default, one per CPU).
+    Each document may use up to *cpu_limit* seconds of CPU time (on systems
+    that support it) before it is abandoned, which protects against
+    pathological pages; with no *cpu_limit*, workers still give up waiting
+    for a document after a minute.
+
+    This function is not thread-safe and should only be called when no checks
+    are being done. It has no effect if a pool has already been started.
+    """
+    global _parser_pool, _parser_cpu_limit
+    if _parser_pool:
+        return
+    _parser_pool = Pool(num_processes, _init_parser_process)
+    _parser_cpu_limit = cpu_limit
+
+def stop_parser_pool():
+    """Return to parsing sources in the worker threads themselves.
+
+    This disables changes made by :func:`start_parser_pool`, and terminates
+    the child processes. It should only be called when no checks are being
+    done.
+    """
+    global _parser_pool, _parser_cpu_limit
+    if not _parser_pool:
+        return
+    _parser_pool.terminate()
+    _parser_pool.join()
+    _parser_pool = None
+    _parser_cpu_limit = None
+
+
+def _get_default_pool():
+    """Return the worker pool used by checks that don't provide their own."""
+    global _default_pool
+    with _default_pool_lock:
+        if not _default_pool:
+            _default_pool = CopyvioWorkerPool()
+        return _default_pool
+
+
+class _CPULimitExceeded(Exception):
+    """Raised in a parser process when a document takes too much CPU time."""
+
+
+def _init_parser_process():
+    """Set up a process in the parser pool."""
+    def handler(signum, frame):
+        raise _CPULimitExceeded()
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Leave this to the parent
+    if resource:
+        signal.signal(signal.SIGXCPU, handler)
+
+def _parse_in_process(content_type, content, args, cpu_limit):
+    """Parse a document in a parser process and return its text, or None.
+
+    We set a soft limit on the CPU time our process may use, *cpu_limit*
+    seconds from now; going over it sends us SIGXCPU, which makes us give up.
+    """
+    handler = get_parser(content_type)
+    if not resource or not cpu_limit:
+        return handler(content, args).parse()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    limit = int(used + cpu_limit) + 1
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+    try:
+        return handler(content, args).parse()
+    except _CPULimitExceeded:
+        return None
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
 
 class _CopyvioQueues(object):
-    """Stores data necessary to maintain the various queues during a check."""
+    """Stores data necessary to maintain the various queues during a check.
+
+    Each check (workspace) has its own queue of sources per domain, stored in
+    :py:attr:`sites` under a ``(domain, workspace)`` key. Domain queues
+    waiting for a worker are handed out by :py:meth:`get` using weighted fair
+    queuing across checks: each check gets a share of the workers
+    proportional to ``4 ** priority``, so interactive checks (with a higher
+    priority) stay fast while big batch checks are running. Among equally
+    served checks, the one with the earliest deadline goes first. A check
+    can also be limited to a number of domain queues being worked on at once.
+
+    Each check's service is counted in virtual time. A check that arrives (or
+    comes back after having nothing queued) starts at the least service of
+    the checks already being worked on, so it doesn't get to catch up on
+    time it wasn't waiting for workers.
+
+    :py:meth:`put` and :py:meth:`release` must be called with :py:attr:`lock`
+    held.
+    """
 
     def __init__(self):
         self.lock = Lock()
         self.sites = {}
-        self.unassigned = Queue()
+        self._ready = Condition(self.lock)
+        self._pending = OrderedDict()  # Workspace -> deque of (key, queue)
+        self._active = defaultdict(int)  # Workspace -> num. of queues held
+        self._served = WeakKeyDictionary()  # Workspace -> virtual time
+        self._vtime = 0.0  # Least virtual time of workspaces being served
+        self._stops = 0
+
+    def _virtual_time(self):
+        """Return the least virtual time of workspaces with work queued."""
+        busy = [self._served.get(workspace, 0) for workspace in self._pending]
+        busy += [self._served.get(workspace, 0)
+                 for workspace, count in self._active.iteritems() if count]
+        if busy:
+            self._vtime = max(self._vtime, min(busy))
+        return self._vtime
+
+    def _select(self, skipped):
+        """Return the workspace whose queue should be handed out next.
+
+        Sources dropped because their check timed out are added to *skipped*.
+        """
+        best = best_rank = None
+        for workspace, pending in self._pending.items():
+            if workspace.timed_out:  # Nobody is waiting for these anymore
+                for key, queue in pending:
+                    skipped.extend(source for source in queue
+                                   if source.skip())
+                    del self.sites[key]
+                del self._pending[workspace]
+                self._forget(workspace)
+                continue
+            limit = workspace.max_domains
+            if limit and self._active[workspace] >= limit:
+                continue
+            until = workspace.until or float("inf")
+            rank = (self._served.get(workspace, 0), until)
+            if best is None or rank < best_rank:
+                best, best_rank = workspace, rank
+        return best
+
+    def _forget(self, workspace):
+        """Drop our records of a workspace if it has nothing left with us.
+
+        Its virtual time is kept until the workspace itself is gone, in case
+        it queues more sources later.
+        """
+        if workspace not in self._pending and not self._active[workspace]:
+            del self._active[workspace]
+
+    def put(self, key, queue):
+        """Make a new domain queue available to the workers."""
+        workspace = key[1]
+        if workspace not in self._pending:
+            if not self._active.get(workspace):
+                start = self._virtual_time()
+                if self._served.get(workspace, 0) < start:
+                    self._served[workspace] = start
+            self._pending[workspace] = deque()
+        self._pending[workspace].append((key, queue))
+        self._ready.notify()
+
+    def release(self, key):
+        """Mark a domain queue handed out by :py:meth:`get` as finished."""
+        workspace = key[1]
+        self._active[workspace] -= 1
+        self._forget(workspace)
+        self._ready.notify()
+
+    def stop(self):
+        """Tell one worker to exit next time it asks for a queue."""
+        with self.lock:
+            self._stops += 1
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """Block until a domain queue is available, and return it.
+
+        Returns a ``(key, queue)`` tuple, or ``(StopIteration, None)`` if the
+        worker should exit. Raises :py:exc:`Queue.Empty` on timeout.
+        """
+        until = (time() + timeout) if timeout is not None else None
+        while True:
+            skipped = []
+            with self.lock:
+                item = self._wait_for_queue(until, skipped)
+            for source in skipped:  # Callbacks may take the lock themselves
+                source.workspace.notify(source, "skipped")
+            if item:
+                return item
+
+    def _wait_for_queue(self, until, skipped):
+        """Do the work of :py:meth:`get` with :py:attr:`lock` held.
+
+        Returns ``None`` early if sources were added to *skipped*, so that
+        they can be announced without the lock.
+        """
+        while True:
+            if self._stops:
+                self._stops -= 1
+                return StopIteration, None
+            workspace = self._select(skipped)
+            if workspace:
+                break
+            if skipped:
+                return None
+            if until is None:
+                self._ready.wait()
+            else:
+                remaining = until - time()
+                if remaining <= 0:
+                    raise Empty
+                self._ready.wait(remaining)
+
+        pending = self._pending[workspace]
+        key, queue = pending.popleft()
+        if not pending:
+            del self._pending[workspace]
+        self._active[workspace] += 1
+        served = self._served.get(workspace, 0)
+        self._served[workspace] = served + 1.0 / workspace.weight
+        return key, queue
 
 
 class _CopyvioWorker(object):
     """A multithreaded URL opener/parser instance."""
+    CHUNK_SIZE = 64 * 1024
+    DEADLINE_FACTOR = 3  # Max. request time, as a multiple of the timeout
 
     def __init__(self, name, queues, until=None):
         self._name = name
@@ -107,7 +364,9 @@ class _CopyvioWorker(object):
 
         self._site = None
         self._queue = None
-        self._opener = build_opener()
+        self._thread = None
+        self._connections = KeepAliveHandler()
+        self._opener = build_opener(self._connections)
         self._logger = getLogger("earwigbot.wiki.cvworker." + name)
 
     def _open_url(self, source):
@@ -119,16 +378,49 @@ class _CopyvioWorker(object):
         content directly if it is plain text. If we don't understand the
         content type, we'll return None.
 
-        If a URLError was raised while opening the URL or an IOError was raised
-        while decompressing, None will be returned.
+        If a URLError was raised while opening the URL, the content was too
+        large or too slow to download (see :py:meth:`_read`), or it couldn't
+        be decompressed, None will be returned. The whole request, from
+        connecting to the end of the body, must finish within
+        :py:attr:`DEADLINE_FACTOR` times the source's timeout; a timer aborts
+        the connection if the server is still sending its headers by then.
+
+        If the check has a source cache, or :func:`cache_sources` was called,
+        we'll use a cached copy of the content if we have one, or revalidate
+        it if it has an ETag.
         """
+        cache = source.workspace.source_cache or _source_cache
+        etag = None
+        if cache:
+            text, etag = cache.get(source.url)
+            if text is not None:
+                logmsg = u"Using cached source: {0}"
+                self._logger.debug(logmsg.format(source.url))
+                return text
+
         if source.headers:
             self._opener.addheaders = source.headers
-        url = source.url.encode("utf8")
+        request = Request(source.url.encode("utf8"))
+        if etag:
+            request.add_header("If-None-Match", etag)
+        start = time()
+        deadline = start + self.DEADLINE_FACTOR * source.timeout
+        watchdog = Timer(deadline - start, self._connections.abort)
+        watchdog.daemon = True
+        watchdog.start()
         try:
-            response = self._opener.open(url, timeout=source.timeout)
+            response = self._opener.open(request, timeout=source.timeout)
+        except HTTPError as exc:
+            if exc.code == 304 and cache:
+                return cache.revalidate(source.url, exc.headers)
+            return None
         except (URLError, HTTPException, socket_error):
+            if time() > deadline:
+                self._logger.debug("Connection took too long; giving up")
             return None
+        finally:
+            watchdog.cancel()
+            source.timings["connect"] = time() - start
 
         try:
             size = int(response.headers.get("Content-Length", 0))
@@ -139,23 +431,126 @@ class _CopyvioWorker(object):
         handler = get_parser(content_type)
         if not handler:
             return None
-        if size > (15 if handler.TYPE == "PDF" else 2) * 1024 ** 2:
+        max_size = (15 if handler.TYPE == "PDF" else 2) * 1024 ** 2
+        if size > max_size:
+            return None
+
+        gzipped = response.headers.get("Content-Encoding") == "gzip"
+        start = time()
+        content = self._read(source, response, max_size, deadline, gzipped)
+        source.timings["download"] = time() - start
+        if content is None:
             return None
 
+        start = time()
+        text = self._parse(handler, content_type, content, source.parser_args)
+        source.timings["parse"] = time() - start
+        if cache and text:
+            cache.set(source.url, text, response.headers)
+        return text
+
+    def _read(self, source, response, max_size, deadline, gzipped=False):
+        """Read the body of a response incrementally, or return None.
+
+        We give up as soon as more than *max_size* bytes have been read, or
+        if the download is still going at the *deadline* timestamp, so that
+        servers can't hold us up by sending huge or slowly dripping responses
+        (socket timeouts only apply to each read, and Content-Length may be
+        missing). If *gzipped* is ``True``, the body is decompressed as it
+        arrives, and the decompressed content is also capped at *max_size*.
+
+        A single read can block for a long time on a slow server even with a
+        socket timeout, so a timer shuts down the connection at the deadline.
+        Byte counts and decompression time are recorded in *source*.
+        """
+        watchdog = Timer(max(deadline - time(), 0), self._shutdown, [response])
+        watchdog.daemon = True
+        watchdog.start()
         try:
-            content = response.read()
-        except (URLError, socket_error):
+            content = self._read_chunks(source, response, max_size, gzipped)
+        finally:
+            watchdog.cancel()
+        if time() > deadline:
+            self._logger.debug("Download took too long; giving up")
             return None
+        return content
 
-        if response.headers.get("Content-Encoding") == "gzip":
-            stream = StringIO(content)
-            gzipper = GzipFile(fileobj=stream)
+    @staticmethod
+    def _shutdown(response):
+        """Forcibly close the socket of a response, interrupting any reads."""
+        try:
+            sock = response.fp._sock.fp._sock
+            sock.shutdown(SHUT_RDWR)
+        except (AttributeError, socket_error):
+            pass
+
+    def _read_chunks(self, source, response, max_size, gzipped):
+        """Read a response in chunks for :py:meth:`_read`; None if too big."""
+        decompressor = None
+        if gzipped:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            source.timings["decompress"] = 0
+        chunks = []
+        while True:
             try:
-                content = gzipper.read()
-            except (IOError, struct_error):
+                chunk = response.read(self.CHUNK_SIZE)
+            except (URLError, HTTPException, socket_error):
                 return None
+            if not chunk:
+                break
+            source.bytes_read += len(chunk)
+            if source.bytes_read > max_size:
+                self._logger.debug("Download is too large; giving up")
+                return None
+            if decompressor:
+                start = time()
+                try:
+                    chunk = decompressor.decompress(
+                        chunk, max_size - source.bytes_decoded + 1)
+                except zlib.error:
+                    return None
+                finally:
+                    source.timings["decompress"] += time() - start
+                if decompressor.unconsumed_tail:
+                    self._logger.debug("Decompressed content is too large")
+                    return None
+            source.bytes_decoded += len(chunk)
+            if source.bytes_decoded > max_size:
+                return None
+            chunks.append(chunk)
 
-        return handler(content).parse()
+        if decompressor:
+            try:
+                chunk = decompressor.flush()
+            except zlib.error:
+                return None
+            source.bytes_decoded += len(chunk)
+            if source.bytes_decoded > max_size:
+                return None
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    def _parse(self, handler, content_type, content, args):
+        """Return the text of a document, parsed with the given handler.
+
+        If :func:`start_parser_pool` was called, HTML and PDF documents are
+        sent to the pool to be parsed there. None is returned if that fails
+        or takes too long (a minute if the pool has no *cpu_limit*).
+        """
+        pool, cpu_limit = _parser_pool, _parser_cpu_limit
+        if not pool or handler.TYPE not in ("HTML", "PDF"):
+            return handler(content, args).parse()
+
+        params = (content_type, content, args, cpu_limit)
+        timeout = 2 * cpu_limit + 5 if cpu_limit else 60
+        try:
+            return pool.apply_async(_parse_in_process, params).get(timeout)
+        except TimeoutError:
+            self._logger.debug("Timed out waiting for parser process")
+            return None
+        except Exception:
+            self._logger.exception("Failed to parse in parser process")
+            return None
 
     def _acquire_new_site(self):
         """Block for a new unassigned site queue."""
@@ -166,11 +561,13 @@ class _CopyvioWorker(object):
         else:
             timeout = None
 
+        self._connections.close_all()  # Don't hold on to the old domain
         self._logger.debug("Waiting for new site queue")
-        site, queue = self._queues.unassigned.get(timeout=timeout)
+        site, queue = self._queues.get(timeout)
         if site is StopIteration:
             raise StopIteration
-        self._logger.debug(u"Acquired new site queue: {0}".format(site))
+        logmsg = u"Acquired new site queue: {0}"
+        self._logger.debug(logmsg.format(site[0]))
         self._site = site
         self._queue = queue
 
@@ -180,13 +577,14 @@ class _CopyvioWorker(object):
             self._acquire_new_site()
 
         logmsg = u"Fetching source URL from queue {0}"
-        self._logger.debug(logmsg.format(self._site))
+        self._logger.debug(logmsg.format(self._site[0]))
         self._queues.lock.acquire()
         try:
             source = self._queue.popleft()
         except IndexError:
             self._logger.debug("Queue is empty")
             del self._queues.sites[self._site]
+            self._queues.release(self._site)
             self._site = None
             self._queue = None
             self._queues.lock.release()
@@ -197,6 +595,12 @@ class _CopyvioWorker(object):
             self._logger.debug("Source has been skipped")
             self._queues.lock.release()
             return self._dequeue()
+        if source.workspace.timed_out:
+            self._logger.debug("Source's check has run out of time")
+            source.skip()
+            self._queues.lock.release()
+            source.workspace.notify(source, "skipped")
+            return self._dequeue()
 
         source.start_work()
         self._queues.lock.release()
@@ -218,45 +622,151 @@ class _CopyvioWorker(object):
             except StopIteration:
                 self._logger.debug("Exiting: got stop signal")
                 return
-            text = self._open_url(source)
-            chain = MarkovChain(text) if text else None
-            source.workspace.compare(source, chain)
+            try:
+                self._handle(source)
+            except Exception:
+                # Pooled workers outlive any one check, so don't let a bad
+                # source kill the thread; just count it as unreadable:
+                logmsg = u"Error while handling source: {0}"
+                self._logger.exception(logmsg.format(source.url))
+                source.workspace.compare(source, None)
+
+    def _handle(self, source):
+        """Fetch a source, and compare it to the article of its check."""
+        workspace = source.workspace
+        workspace.notify(source, "started")
+        text = self._open_url(source)
+        if text:
+            workspace.notify(source, "fetched")
+        start = time()
+        chain = workspace.build_chain(text) if text else None
+        if chain:
+            source.timings["chain"] = time() - start
+        workspace.compare(source, chain)
+
+    def is_alive(self):
+        """Return whether the worker's thread is running."""
+        return bool(self._thread) and self._thread.is_alive()
 
     def start(self):
         """Start the copyvio worker in a new thread."""
         thread = Thread(target=self._run, name="cvworker-" + self._name)
+        self._thread = thread
         thread.daemon = True
         thread.start()
 
 
+class CopyvioWorkerPool(object):
+    """
+    **EarwigBot: Wiki Toolset: Copyvio Worker Pool**
+
+    A reusable set of worker threads for checks that aren't using
+    :func:`globalize`\ d workers. Threads are only started when a check first
+    needs them, and are kept running for later checks, instead of being
+    started and stopped for every check. Checks sharing a pool share its
+    queues, like globalized checks do; each check's *max_time* is still
+    respected, as workers skip sources of checks that have run out of time.
+
+    By default, all checks use one shared pool, but callers can make their
+    own (for example, to keep a batch task from competing with interactive
+    checks) and pass it to :py:meth:`~.CopyvioMixIn.copyvio_check`.
+    """
+
+    def __init__(self, num_workers=8):
+        self._num_workers = num_workers
+        self._queues = _CopyvioQueues()
+        self._workers = []
+        self._lock = Lock()
+
+    def __repr__(self):
+        """Return the canonical string representation of the pool."""
+        return "CopyvioWorkerPool(num_workers={0!r})".format(
+            self._num_workers)
+
+    def __str__(self):
+        """Return a nice string representation of the pool."""
+        res = "<CopyvioWorkerPool with {0} running workers>"
+        return res.format(len(self._workers))
+
+    def get_queues(self, num_workers=None):
+        """Return the pool's queues, starting its workers if needed.
+
+        If *num_workers* is given and more than the pool's size, the pool is
+        grown to that many workers. Workers whose threads have died are
+        replaced.
+        """
+        with self._lock:
+            if num_workers > self._num_workers:
+                self._num_workers = num_workers
+            self._workers = [worker for worker in self._workers
+                             if worker.is_alive()]
+            while len(self._workers) < self._num_workers:
+                name = "pool-{0:04}.{1}".format(id(self) % 10000,
+                                                len(self._workers))
+                worker = _CopyvioWorker(name, self._queues)
+                worker.start()
+                self._workers.append(worker)
+        return self._queues
+
+    def stop(self):
+        """Stop the pool's worker threads.
+
+        The pool can still be used afterwards; new workers will be started
+        when they are needed. This should only be called when no checks are
+        using the pool.
+        """
+        with self._lock:
+            for i in xrange(len(self._workers)):
+                self._queues.stop()
+            self._workers = []
+            self._queues = _CopyvioQueues()
+
+
 class CopyvioWorkspace(object):
     """Manages a single copyvio check distributed across threads."""
 
     def __init__(self, article, min_confidence, max_time, logger, headers,
-                 url_timeout=5, num_workers=8, short_circuit=True):
+                 url_timeout=5, num_workers=8, short_circuit=True,
+                 parser_args=None, pool=None, priority=0, max_domains=None,
+                 source_cache=None, callback=None):
         self.sources = []
         self.finished = False
+        self.stopped = False
         self.possible_miss = False
+        self.best_confidence = 0.0
+        self.timings = {}
 
         self._article = article
         self._logger = logger.getChild("copyvios")
         self._min_confidence = min_confidence
         self._start_time = time()
         self._until = (self._start_time + max_time) if max_time > 0 else None
+        self.weight = 4.0 ** priority
+        self.max_domains = max_domains
+        self.source_cache = source_cache
         self._handled_urls = set()
         self._finish_lock = Lock()
         self._short_circuit = short_circuit
+        self._callback = callback
         self._source_args = {"workspace": self, "headers": headers,
-                             "timeout": url_timeout}
+                             "timeout": url_timeout,
+                             "parser_args": parser_args}
 
         if _is_globalized:
             self._queues = _global_queues
         else:
-            self._queues = _CopyvioQueues()
-            self._num_workers = num_workers
-            for i in xrange(num_workers):
-                name = "local-{0:04}.{1}".format(id(self) % 10000, i)
-                _CopyvioWorker(name, self._queues, self._until).start()
+            pool = pool or _get_default_pool()
+            self._queues = pool.get_queues(num_workers)
+
+    @property
+    def until(self):
+        """The timestamp at which the check must end, or None."""
+        return self._until
+
+    @property
+    def timed_out(self):
+        """Whether the check has gone past its *max_time*."""
+        return bool(self._until) and time() > self._until
 
     def _calculate_confidence(self, delta):
         """Return the confidence of a violation as a float between 0 and 1."""
@@ -292,13 +802,55 @@ class CopyvioWorkspace(object):
         return abs(max(conf_with_article_and_delta(self._article.size, d_size),
                        conf_with_delta(d_size)))
 
+    def build_chain(self, text):
+        """Return a chain of the given source text to compare to the article.
+
+        The chain is the same type as the article's, so they can be compared.
+        """
+        return type(self._article)(text)
+
     def _finish_early(self):
-        """Finish handling links prematurely (if we've hit min_confidence)."""
+        """Finish handling links prematurely (if we've hit min_confidence).
+
+        Returns a list of the sources that were skipped.
+        """
         self._logger.debug("Confidence threshold met; skipping remaining sources")
         with self._queues.lock:
-            for source in self.sources:
-                source.skip()
+            skipped = [source for source in self.sources if source.skip()]
             self.finished = True
+        return skipped
+
+    def notify(self, source, event):
+        """Tell the check's callback, if any, that a source has changed.
+
+        *event* is one of ``"queued"``, ``"started"``, ``"fetched"``,
+        ``"compared"``, or ``"skipped"``. If the callback returns ``True``,
+        the check is stopped with :py:meth:`stop`.
+        """
+        if not self._callback:
+            return
+        try:
+            stop = self._callback(event, source, self.best_confidence)
+        except Exception:
+            self._logger.exception("Error in copyvio check callback")
+            return
+        if stop:
+            self.stop()
+
+    def stop(self):
+        """Stop the check early, skipping any sources not being worked on.
+
+        Searching also stops, so the result may have missed some sources.
+        """
+        if self.stopped:
+            return
+        self._logger.debug("Check stopped; skipping remaining sources")
+        with self._queues.lock:
+            self.stopped = True
+            self.possible_miss = True
+            skipped = [source for source in self.sources if source.skip()]
+        for source in skipped:
+            self.notify(source, "skipped")
 
     def enqueue(self, urls, exclude_check=None):
         """Put a list of URLs into the various worker queues.
@@ -315,45 +867,124 @@ class CopyvioWorkspace(object):
                     continue
 
                 source = CopyvioSource(url=url, **self._source_args)
-                self.sources.append(source)
-                if self._short_circuit and self.finished:
+                if self.stopped or (self._short_circuit and self.finished):
                     self._logger.debug(u"enqueue(): auto-skip {0}".format(url))
+                    self.sources.append(source)
                     source.skip()
-                    continue
+            if source.skipped:
+                self.notify(source, "skipped")
+                continue
 
-                try:
-                    key = tldextract.extract(url).registered_domain
-                except ImportError:  # Fall back on very naive method
-                    from urlparse import urlparse
-                    key = u".".join(urlparse(url).netloc.split(".")[-2:])
-
-                logmsg = u"enqueue(): {0} {1} -> {2}"
-                if key in self._queues.sites:
-                    self._logger.debug(logmsg.format("append", key, url))
-                    self._queues.sites[key].append(source)
+            # Announce the source before any worker can pick it up, so the
+            # callback sees "queued" before "started":
+            self.notify(source, "queued")
+            with self._queues.lock:
+                self.sources.append(source)
+                if self.stopped or (self._short_circuit and self.finished):
+                    source.skip()
                 else:
-                    self._logger.debug(logmsg.format("new", key, url))
-                    self._queues.sites[key] = queue = deque()
-                    queue.append(source)
-                    self._queues.unassigned.put((key, queue))
+                    self._put_source(url, source)
+            if source.skipped:
+                self.notify(source, "skipped")
+
+    def _put_source(self, url, source):
+        """Add a source to the queue for its domain, making it if needed."""
+        try:
+            key = tldextract.extract(url).registered_domain
+        except ImportError:  # Fall back on very naive method
+            from urlparse import urlparse
+            key = u".".join(urlparse(url).netloc.split(".")[-2:])
+
+        logmsg = u"enqueue(): {0} {1} -> {2}"
+        if (key, self) in self._queues.sites:
+            self._logger.debug(logmsg.format("append", key, url))
+            self._queues.sites[key, self].append(source)
+        else:
+            self._logger.debug(logmsg.format("new", key, url))
+            self._queues.sites[key, self] = queue = deque()
+            queue.append(source)
+            self._queues.put((key, self), queue)
+
+    def search(self, searcher, queries, exclude_check=None, num_threads=1):
+        """Run search engine queries and enqueue the URLs they return.
+
+        *searcher* is a search engine, and *queries* a list of queries to
+        give it. Up to *num_threads* queries are run at once, and each result
+        is passed to :py:meth:`enqueue` (with *exclude_check*) as soon as it
+        is ready, so sources can be compared while other queries are pending.
+        If we short-circuit, remaining queries are abandoned.
+
+        Returns the number of queries made. If any query raised an exception,
+        the first one is re-raised once all running queries have finished.
+        """
+        pending = deque(queries)
+        lock = Lock()
+        state = {"queries": 0, "error": None}
+        self.timings.setdefault("queries", [])
+
+        def run():
+            while True:
+                with lock:
+                    if not pending or state["error"]:
+                        return
+                    if self.stopped:
+                        return
+                    if self._short_circuit and self.finished:
+                        self.possible_miss = True
+                        return
+                    query = pending.popleft()
+                log = u"search(): querying {0} for {1!r}"
+                self._logger.debug(log.format(searcher.name, query))
+                start = time()
+                try:
+                    urls = searcher.search(query)
+                except Exception as exc:
+                    with lock:
+                        state["error"] = state["error"] or exc
+                    return
+                with lock:
+                    state["queries"] += 1
+                    self.timings["queries"].append(time() - start)
+                self.enqueue(urls, exclude_check)
+
+        threads = []
+        for i in xrange(min(num_threads, len(pending)) - 1):
+            name = "cvsearch-{0:04}.{1}".format(id(self) % 10000, i)
+            thread = Thread(target=run, name=name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        run()  # The calling thread does its share of the work too
+        for thread in threads:
+            thread.join()
+        if state["error"]:
+            raise state["error"]
+        return state["queries"]
 
     def compare(self, source, source_chain):
         """Compare a source to the article; call _finish_early if necessary."""
         if source_chain:
-            delta = MarkovChainIntersection(self._article, source_chain)
+            start = time()
+            delta = self._article.intersect(source_chain)
             conf = self._calculate_confidence(delta)
+            source.timings["compare"] = time() - start
         else:
             conf = 0.0
         self._logger.debug(u"compare(): {0} -> {1}".format(source.url, conf))
+        skipped = []
         with self._finish_lock:
             if source_chain:
                 source.update(conf, source_chain, delta)
+            self.best_confidence = max(self.best_confidence, conf)
             source.finish_work()
             if not self.finished and conf >= self._min_confidence:
                 if self._short_circuit:
-                    self._finish_early()
+                    skipped = self._finish_early()
                 else:
                     self.finished = True
+        self.notify(source, "compared")
+        for other in skipped:
+            self.notify(other, "skipped")
 
     def wait(self):
         """Wait for the workers to finish handling the sources."""
@@ -362,9 +993,6 @@ class CopyvioWorkspace(object):
             source.join(self._until)
         with self._finish_lock:
             pass  # Wait for any remaining comparisons to be finished
-        if not _is_globalized:
-            for i in xrange(self._num_workers):
-                self._queues.unassigned.put((StopIteration, None))
 
     def get_result(self, num_queries=0):
         """Return a CopyvioCheckResult containing the results of this check."""
@@ -374,6 +1002,8 @@ class CopyvioWorkspace(object):
             return int(s1.skipped) - int(s2.skipped)
 
         self.sources.sort(cmpfunc)
-        return CopyvioCheckResult(self.finished, self.sources, num_queries,
-                                  time() - self._start_time, self._article,
-                                  self.possible_miss)
+        result = CopyvioCheckResult(self.finished, self.sources, num_queries,
+                                    time() - self._start_time, self._article,
+                                    self.possible_miss)
+        result.timings = self.timings
+        return result
@@ -0,0 +1,457 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2009-2015 Ben Kurtovic <ben.kurtovic@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from bz2 import BZ2Decompressor, BZ2File
+from multiprocessing import Pool
+from os import path
+from xml.etree import cElementTree as etree
+
+import mwparserfromhell
+
+from earwigbot import exceptions
+from earwigbot.wiki import constants
+from earwigbot.wiki.page import PageRef
+
+__all__ = ["DumpPage", "DumpSite", "iter_dump"]
+
+def _strip_ns(tag):
+    """Remove the XML namespace from an element's tag, if present."""
+    return tag.rsplit("}", 1)[-1]
+
+def _unicodeify(value):
+    """Return the text of an element as unicode (or an empty string)."""
+    if value is None:
+        return u""
+    if isinstance(value, unicode):
+        return value
+    return value.decode("utf8")
+
+
+class _BZ2Reader(object):
+    """A file-like object that decompresses concatenated bzip2 streams.
+
+    Python's BZ2File stops reading after the first stream, but multistream
+    dumps contain thousands of them, and other dumps may be compressed in
+    parallel. Reading starts at the file's current position and stops at
+    *end*, if given. *prefix* and *suffix* are returned before and after the
+    decompressed data, which lets us wrap a range of <page> elements in a root
+    element.
+    """
+    BLOCK_SIZE = 256 * 1024
+
+    def __init__(self, fileobj, end=None, prefix="", suffix=""):
+        self._file = fileobj
+        self._end = end
+        self._suffix = suffix
+        self._buffer = prefix
+        self._decompressor = BZ2Decompressor()
+        self._eof = False
+
+    def _fill(self):
+        """Decompress the next block of data into our buffer."""
+        size = self.BLOCK_SIZE
+        if self._end is not None:
+            size = min(size, self._end - self._file.tell())
+        data = self._file.read(size) if size > 0 else ""
+        if not data:
+            self._buffer += self._suffix
+            self._eof = True
+            return
+
+        chunks = [self._buffer]
+        while data:
+            try:
+                chunks.append(self._decompressor.decompress(data))
+            except EOFError:  # The last stream ended exactly on a block
+                self._decompressor = BZ2Decompressor()
+                continue
+            data = self._decompressor.unused_data
+            if data:  # A new stream begins in the middle of this block
+                self._decompressor = BZ2Decompressor()
+        self._buffer = "".join(chunks)
+
+    def read(self, size=-1):
+        """Read up to *size* bytes of decompressed data."""
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size < 0:
+            data, self._buffer = self._buffer, ""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        """Close the underlying compressed file."""
+        self._file.close()
+
+
+def _map_range(args):
+    """Apply a function to the pages within a range of a multistream dump.
+
+    This runs inside a child process started by :py:meth:`DumpSite.map`, so
+    it must be a module-level function. Results that are ``None`` are dropped.
+    """
+    site, func, start, end, namespaces = args
+    results = []
+    for page in site._iter_range(start, end, namespaces):
+        result = func(page)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+class DumpPage(object):
+    """
+    **EarwigBot: Wiki Toolset: Dump Page**
+
+    Represents a page read from an XML dump by a
+    :py:class:`~earwigbot.wiki.dump.DumpSite`. This implements the read side
+    of :py:class:`~earwigbot.wiki.page.Page` with the page's content held in
+    memory, so no API queries are ever made.
+
+    *Attributes:*
+
+    - :py:attr:`site`:        the page's corresponding DumpSite object
+    - :py:attr:`title`:       the page's title, or pagename
+    - :py:attr:`pageid`:      an integer ID representing the page
+    - :py:attr:`namespace`:   the page's namespace as an integer
+    - :py:attr:`lastrevid`:   the ID of the page's revision in the dump
+    - :py:attr:`is_talkpage`: ``True`` if this is a talkpage, else ``False``
+    - :py:attr:`is_redirect`: ``True`` if this is a redirect, else ``False``
+
+    *Public methods:*
+
+    - :py:meth:`get`:         returns the page's content
+    - :py:meth:`parse`:       parses the page content for templates, links, etc
+    """
+    __slots__ = ("_site", "_title", "_namespace", "_pageid", "_lastrevid",
+                 "_content", "_is_redirect")
+
+    def __init__(self, site, title, namespace, pageid, lastrevid, content,
+                 is_redirect=False):
+        self._site = site
+        self._title = title
+        self._namespace = namespace
+        self._pageid = pageid
+        self._lastrevid = lastrevid
+        self._content = content
+        self._is_redirect = is_redirect
+
+    def __repr__(self):
+        """Return the canonical string representation of the DumpPage."""
+        res = "DumpPage(title={0!r}, pageid={1!r}, site={2!r})"
+        return res.format(self._title, self._pageid, self._site)
+
+    def __str__(self):
+        """Return a nice string representation of the DumpPage."""
+        return '<DumpPage "{0}" of {1}>'.format(self.title, str(self.site))
+
+    @property
+    def site(self):
+        """The page's corresponding DumpSite object."""
+        return self._site
+
+    @property
+    def title(self):
+        """The page's title, or "pagename"."""
+        return self._title
+
+    @property
+    def pageid(self):
+        """An integer ID representing the page."""
+        return self._pageid
+
+    @property
+    def namespace(self):
+        """The page's namespace ID (an integer)."""
+        return self._namespace
+
+    @property
+    def lastrevid(self):
+        """The ID of the page's revision in the dump.
+
+        For dumps containing only current revisions, this is the page's most
+        recent revision as of the time the dump was made.
+        """
+        return self._lastrevid
+
+    @property
+    def is_talkpage(self):
+        """``True`` if the page is a talkpage, otherwise ``False``."""
+        return self._namespace >= 0 and self._namespace % 2 == 1
+
+    @property
+    def is_redirect(self):
+        """``True`` if the page is a redirect, otherwise ``False``."""
+        return self._is_redirect
+
+    def get(self):
+        """Return page content."""
+        return self._content
+
+    def parse(self):
+        """Parse the page content for templates, links, etc.
+
+        Actual parsing is handled by :py:mod:`mwparserfromhell`.
+        """
+        return mwparserfromhell.parse(self._content)
+
+
+class DumpSite(object):
+    """
+    **EarwigBot: Wiki Toolset: Dump Site**
+
+    Represents a site as seen through one of its XML dumps, like
+    :file:`enwiki-latest-pages-articles.xml.bz2`, allowing bulk tasks to read
+    every page locally instead of through the API. The dump may be
+    uncompressed or compressed with bzip2 (including multistream dumps). It is
+    read with a streaming parser, so memory use stays constant no matter how
+    large it is.
+
+    *Attributes:*
+
+    - :py:attr:`name`:    the site's name (or "wikiid"), like ``"enwiki"``
+    - :py:attr:`path`:    the path to the dump file
+
+    *Public methods:*
+
+    - :py:meth:`namespace_id_to_name`: returns names associated with an NS id
+    - :py:meth:`get_pages`:            iterates over DumpPages in the dump
+    - :py:meth:`map`:                  applies a function to every page, using
+      multiple processes for multistream dumps
+    """
+
+    def __init__(self, dump_path, index_path=None):
+        """Constructor for new DumpSite instances.
+
+        *dump_path* is the path to the dump file. *index_path* is the path to
+        the index of a multistream dump (like
+        :file:`enwiki-latest-pages-articles-multistream-index.txt.bz2`), which
+        is needed to split the work in :py:meth:`map` across processes. If it
+        isn't given, we'll look for it next to the dump.
+
+        No data is read from the dump until it is needed.
+        """
+        self._path = dump_path
+        self._index_path = index_path
+        self._siteinfo = None
+
+        if not index_path and "multistream" in dump_path:
+            guess = dump_path.replace(".xml.bz2", "-index.txt.bz2")
+            if path.exists(guess):
+                self._index_path = guess
+
+    def __repr__(self):
+        """Return the canonical string representation of the DumpSite."""
+        res = "DumpSite(dump_path={0!r}, index_path={1!r})"
+        return res.format(self._path, self._index_path)
+
+    def __str__(self):
+        """Return a nice string representation of the DumpSite."""
+        return "<DumpSite of {0}>".format(self._path)
+
+    def _open(self):
+        """Return a file-like object for reading the dump's XML."""
+        if self._path.endswith(".bz2"):
+            return _BZ2Reader(open(self._path, "rb"))
+        return open(self._path, "rb")
+
+    def _load_siteinfo(self):
+        """Read the <siteinfo> header at the start of the dump."""
+        siteinfo = {"name": None, "namespaces": {}}
+        stream = self._open()
+        try:
+            for event, elem in etree.iterparse(stream):
+                tag = _strip_ns(elem.tag)
+                if tag == "dbname":
+                    siteinfo["name"] = _unicodeify(elem.text)
+                elif tag == "namespace":
+                    ns_id = int(elem.get("key"))
+                    siteinfo["namespaces"][ns_id] = _unicodeify(elem.text)
+                elif tag == "siteinfo":
+                    break
+        finally:
+            stream.close()
+        self._siteinfo = siteinfo
+
+    def _parse_pages(self, stream, namespaces=None, refs=False):
+        """Iterate over DumpPages (or PageRefs) parsed from dump XML."""
+        context = etree.iterparse(stream, events=("start", "end"))
+        root = None
+        for event, elem in context:
+            if root is None:
+                root = elem
+            if event != "end" or _strip_ns(elem.tag) != "page":
+                continue
+
+            data = {"redirect": False}
+            for child in elem.iter():
+                tag = _strip_ns(child.tag)
+                if tag == "redirect":
+                    data["redirect"] = True
+                elif tag == "revision":
+                    for field in child:
+                        ftag = _strip_ns(field.tag)
+                        if ftag in ("id", "text"):
+                            data["rev" + ftag] = field.text
+                elif tag in ("title", "ns", "id") and tag not in data:
+                    data[tag] = child.text
+
+            ns_id = int(data.get("ns", constants.NS_MAIN))
+            if refs and (namespaces is None or ns_id in namespaces):
+                title = _unicodeify(data.get("title"))
+                yield PageRef(self, title, ns_id, int(data["id"]))
+            elif namespaces is None or ns_id in namespaces:
+                lastrevid = data.get("revid")
+                yield DumpPage(
+                    self, _unicodeify(data.get("title")), ns_id,
+                    int(data["id"]), int(lastrevid) if lastrevid else None,
+                    _unicodeify(data.get("revtext")), data["redirect"])
+            root.clear()  # Keep memory use constant
+
+    def _iter_range(self, start, end, namespaces=None):
+        """Iterate over the pages in a byte range of a multistream dump.
+
+        *end* may be ``None`` to read to the end of the file, in which case
+        the dump's own closing tag ends our root element.
+        """
+        with open(self._path, "rb") as fp:
+            fp.seek(start)
+            suffix = "</mediawiki>" if end is not None else ""
+            stream = _BZ2Reader(fp, end, "<mediawiki>", suffix)
+            for page in self._parse_pages(stream, namespaces):
+                yield page
+
+    def _get_ranges(self, streams_per_range):
+        """Return a list of (start, end) byte ranges from the dump's index.
+
+        Each line in the index looks like ``offset:pageid:title``, where the
+        offset is the start of the bzip2 stream containing the page.
+        """
+        offsets = []
+        with BZ2File(self._index_path) as index:
+            for line in index:
+                offset = int(line.split(":", 1)[0])
+                if not offsets or offsets[-1] != offset:
+                    offsets.append(offset)
+
+        ranges = []
+        for i in xrange(0, len(offsets), streams_per_range):
+            end = i + streams_per_range
+            end_offset = offsets[end] if end < len(offsets) else None
+            ranges.append((offsets[i], end_offset))
+        return ranges
+
+    @property
+    def name(self):
+        """The site's name (or "wikiid"), like ``"enwiki"``.
+
+        This is read from the dump's header the first time it is needed.
+        """
+        if not self._siteinfo:
+            self._load_siteinfo()
+        return self._siteinfo["name"]
+
+    @property
+    def path(self):
+        """The path to the dump file."""
+        return self._path
+
+    def namespace_id_to_name(self, ns_id):
+        """Given a namespace ID, return its name as listed in the dump.
+
+        Raises :py:exc:`~earwigbot.exceptions.NamespaceNotFoundError` if the ID
+        is not found.
+        """
+        if not self._siteinfo:
+            self._load_siteinfo()
+        try:
+            return self._siteinfo["namespaces"][ns_id]
+        except KeyError:
+            e = "There is no namespace with id {0}.".format(ns_id)
+            raise exceptions.NamespaceNotFoundError(e)
+
+    def get_pages(self, namespaces=None, refs=False):
+        """Iterate over every page in the dump as DumpPages.
+
+        If *namespaces* is given, it should be a collection of namespace IDs;
+        pages in other namespaces will be skipped. If *refs* is ``True``, we
+        will yield compact :py:class:`~earwigbot.wiki.page.PageRef`\ s
+        without the pages' content instead; pass a live
+        :py:class:`~earwigbot.wiki.site.Site` to their
+        :py:meth:`~earwigbot.wiki.page.PageRef.to_page` to get full Pages.
+        """
+        if namespaces is not None:
+            namespaces = set(namespaces)
+        stream = self._open()
+        try:
+            for page in self._parse_pages(stream, namespaces, refs):
+                yield page
+        finally:
+            stream.close()
+
+    def map(self, func, processes=None, namespaces=None,
+            streams_per_range=100):
+        """Apply *func* to every page in the dump and iterate over the results.
+
+        *func* is called with each :py:class:`DumpPage`; results that are
+        ``None`` are dropped, so it can act as a filter. *namespaces* works as
+        it does for :py:meth:`get_pages`.
+
+        If this is a multistream dump with a known index, the dump is split
+        into ranges of *streams_per_range* bzip2 streams, which are handed to
+        a pool of *processes* worker processes (defaulting to the number of
+        CPUs). *func* must then be picklable, i.e. a module-level function.
+        Results are yielded in dump order. Otherwise, pages are handled one by
+        one in this process.
+        """
+        if namespaces is not None:
+            namespaces = set(namespaces)
+
+        if not self._index_path:
+            for page in self.get_pages(namespaces):
+                result = func(page)
+                if result is not None:
+                    yield result
+            return
+
+        if not self._siteinfo:
+            self._load_siteinfo()  # Avoid loading it in every child process
+        ranges = self._get_ranges(streams_per_range)
+        tasks = [(self, func, start, end, namespaces) for start, end in ranges]
+        pool = Pool(processes)
+        try:
+            for results in pool.imap(_map_range, tasks):
+                for result in results:
+                    yield result
+        finally:
+            pool.terminate()
+
+
+def iter_dump(dump_path, namespaces=None, refs=False):
+    """Iterate over every page in an XML dump as DumpPages.
+
+    This is shorthand for :py:meth:`DumpSite(dump_path).get_pages(namespaces,
+    refs) <earwigbot.wiki.dump.DumpSite.get_pages>`.
+    """
+    return DumpSite(dump_path).get_pages(namespaces, refs)
@@ -20,6 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from collections import namedtuple
 from hashlib import md5
 from logging import getLogger, NullHandler
 import re
@@ -31,7 +32,7 @@ import mwparserfromhell
 from earwigbot import exceptions
 from earwigbot.wiki.copyvios import CopyvioMixIn
 
-__all__ = ["Page"]
+__all__ = ["Page", "PageRef"]
 
 class Page(CopyvioMixIn):
     """
@@ -733,3 +734,42 @@ class Page(CopyvioMixIn):
                 return False
 
         return True
+
+
+class PageRef(namedtuple("PageRef", ["site", "title", "namespace", "pageid"])):
+    """
+    **EarwigBot: Wiki Toolset: Page Reference**
+
+    A compact, immutable reference to a page: a tuple of its site, title,
+    namespace ID, and page ID (which may be ``None``). It is much smaller than
+    a full :py:class:`~earwigbot.wiki.page.Page`, so it's suited to holding
+    large sets of pages in memory (for deduplication or comparison, for
+    example). Iterators like :py:meth:`category.get_members()
+    <earwigbot.wiki.category.Category.get_members>` yield these when asked.
+
+    *Public methods:*
+
+    - :py:meth:`to_page`: returns a full Page object for the reference
+    """
+    __slots__ = ()
+
+    def to_page(self, follow_redirects=False, site=None):
+        """Return a full :py:class:`~earwigbot.wiki.page.Page` for this page.
+
+        The page is created with :py:meth:`site.get_page()
+        <earwigbot.wiki.site.Site.get_page>`, so it may be a
+        :py:class:`~earwigbot.wiki.category.Category`. *site* can be given to
+        use a different site than the reference's own, such as a live
+        :py:class:`~earwigbot.wiki.site.Site` for a reference read from a
+        :py:class:`~earwigbot.wiki.dump.DumpSite`; the page ID is only kept if
+        the site is the same. Since a DumpSite can't make pages itself, *site*
+        is required for those references, and :py:exc:`ValueError` is raised
+        without it.
+        """
+        if site is None or site is self.site:
+            if not hasattr(self.site, "get_page"):
+                err = "A live site is needed to make a page from {0!r}"
+                raise ValueError(err.format(self.site))
+            return self.site.get_page(self.title, follow_redirects,
+                                      self.pageid)
+        return site.get_page(self.title, follow_redirects)
@@ -25,6 +25,7 @@ from gzip import GzipFile
 from json import loads
 from logging import getLogger, NullHandler
 from os.path import expanduser
+import re
 from StringIO import StringIO
 from threading import RLock
 from time import sleep, time
@@ -35,6 +36,7 @@ from urlparse import urlparse
 from earwigbot import exceptions, importer
 from earwigbot.wiki import constants
 from earwigbot.wiki.category import Category
+from earwigbot.wiki.copyvios import copyvio_check_many
 from earwigbot.wiki.page import Page
 from earwigbot.wiki.user import User
 
@@ -76,9 +78,12 @@ class Site(object):
     - :py:meth:`get_token`:            gets a token for a specific API action
     - :py:meth:`namespace_id_to_name`: returns names associated with an NS id
     - :py:meth:`namespace_name_to_id`: returns the ID associated with a NS name
+    - :py:meth:`normalize_title`:      normalizes a title without the API
     - :py:meth:`get_page`:             returns a Page for the given title
     - :py:meth:`get_category`:         returns a Category for the given title
     - :py:meth:`get_user`:             returns a User object for the given name
+    - :py:meth:`get_revisions`:        iterates over revisions given their IDs
+    - :py:meth:`copyvio_check_many`:   checks many pages for copyvios at once
     - :py:meth:`delegate`:             controls when the API or SQL is used
     """
     SERVICE_API = 1
@@ -118,6 +123,8 @@ class Site(object):
         self._article_path = article_path
         self._script_path = script_path
         self._namespaces = namespaces
+        self._namespace_ids = {}  # Built from _namespaces for fast lookups
+        self._title_info = None  # Loaded on demand by _get_title_info()
 
         # Attributes used for API queries:
         self._use_https = use_https
@@ -165,6 +172,7 @@ class Site(object):
 
         # Get all of the above attributes that were not specified as arguments:
         self._load_attributes()
+        self._build_namespace_ids()
 
         # If we have a name/pass and the API says we're not logged in, log in:
         self._login_info = name, password = login
@@ -356,6 +364,7 @@ class Site(object):
             with self._api_lock:
                 result = self._api_query(params, no_assert=True)
             self._load_namespaces(result)
+            self._build_namespace_ids()
         elif all(attrs):  # Everything is already specified and we're not told
             return        # to force a reload, so do nothing
         else:  # We're only loading attributes other than _namespaces
@@ -396,6 +405,49 @@ class Site(object):
             alias = namespace["*"]
             self._namespaces[ns_id].append(alias)
 
+    def _build_namespace_ids(self):
+        """Fill self._namespace_ids with a map of namespace names to IDs.
+
+        Keys are folded with _fold_namespace_name(), so lookups can ignore case
+        and the difference between underscores and spaces. This is rebuilt
+        whenever our namespaces are (re)loaded.
+        """
+        self._namespace_ids = {}
+        for ns_id, names in self._namespaces.iteritems():
+            for name in names:
+                self._namespace_ids[self._fold_namespace_name(name)] = ns_id
+
+    def _fold_namespace_name(self, name):
+        """Return a namespace name in the form used as a key for lookups."""
+        return self._collapse_title(name).lower()
+
+    def _collapse_title(self, title):
+        """Collapse runs of whitespace and underscores in a title to spaces."""
+        return re.sub(r"[_\s]+", u" ", title, flags=re.UNICODE).strip()
+
+    def _get_title_info(self):
+        """Return information used to normalize titles, loading it if needed.
+
+        This is a dict containing the capitalization rule for each namespace
+        (``"first-letter"`` or ``"case-sensitive"``) and the set of interwiki
+        prefixes known to the site. It needs a single API query, made the
+        first time it is asked for.
+        """
+        if self._title_info:
+            return self._title_info
+
+        result = self.api_query(action="query", meta="siteinfo",
+                                siprop="general|namespaces|interwikimap")
+        default = result["query"]["general"].get("case", "first-letter")
+        cases = {}
+        for namespace in result["query"]["namespaces"].values():
+            cases[namespace["id"]] = namespace.get("case", default)
+        interwikis = set(iw["prefix"].lower()
+                         for iw in result["query"].get("interwikimap", []))
+        self._title_info = {"default_case": default, "cases": cases,
+                            "interwikis": interwikis}
+        return self._title_info
+
     def _get_cookie(self, name, domain):
         """Return the named cookie unless it is expired or doesn't exist."""
         for cookie in self._cookiejar:
@@ -838,14 +890,45 @@ class Site(object):
         Raises :py:exc:`~earwigbot.exceptions.NamespaceNotFoundError` if the
         name is not found.
         """
-        lname = name.lower()
-        for ns_id, names in self._namespaces.items():
-            lnames = [n.lower() for n in names]  # Be case-insensitive
-            if lname in lnames:
-                return ns_id
+        try:
+            return self._namespace_ids[self._fold_namespace_name(name)]
+        except KeyError:
+            e = u"There is no namespace with name '{0}'.".format(name)
+            raise exceptions.NamespaceNotFoundError(e)
 
-        e = u"There is no namespace with name '{0}'.".format(name)
-        raise exceptions.NamespaceNotFoundError(e)
+    def normalize_title(self, title):
+        """Return the normalized form of the given title, without the API.
+
+        This mimics what MediaWiki does to titles: underscores and runs of
+        whitespace become single spaces, a leading colon is dropped, namespace
+        prefixes (including aliases, in any case) are replaced with the
+        namespace's primary name, and the first letter of the title is
+        capitalized unless the namespace is case-sensitive. Titles starting
+        with an interwiki prefix only have their prefix lowercased. This is
+        useful for comparing or deduplicating titles before loading them.
+
+        The first call makes a single API query for the site's capitalization
+        rules and interwiki prefixes; after that, no queries are made.
+        """
+        info = self._get_title_info()
+        title = self._collapse_title(self._unicodeify(title))
+        if title.startswith(u":"):
+            title = title[1:].lstrip()
+
+        ns_id, body = constants.NS_MAIN, title
+        if u":" in title:
+            prefix, rest = title.split(u":", 1)
+            folded = self._fold_namespace_name(prefix)
+            if folded in self._namespace_ids:
+                ns_id, body = self._namespace_ids[folded], rest.lstrip()
+            elif folded in info["interwikis"]:
+                return u":".join((folded, rest.lstrip()))
+
+        case = info["cases"].get(ns_id, info["default_case"])
+        if case == "first-letter" and body:
+            body = body[0].upper() + body[1:]
+        ns_name = self._namespaces[ns_id][0] if ns_id else u""
+        return u":".join((ns_name, body)) if ns_name else body
 
     def get_page(self, title, follow_redirects=False, pageid=None):
         """Return a :py:class:`Page` object for the given title.
@@ -862,10 +945,10 @@ class Site(object):
         provide that.
         """
         title = self._unicodeify(title)
-        prefixes = self.namespace_id_to_name(constants.NS_CATEGORY, all=True)
         prefix = title.split(":", 1)[0]
         if prefix != title:  # Avoid a page that is simply "Category"
-            if prefix in prefixes:
+            folded = self._fold_namespace_name(prefix)
+            if self._namespace_ids.get(folded) == constants.NS_CATEGORY:
                 return Category(self, title, follow_redirects, pageid,
                                 self._logger)
         return Page(self, title, follow_redirects, pageid, self._logger)
@@ -895,6 +978,68 @@ class Site(object):
             username = self._get_username()
         return User(self, username, self._logger)
 
+    def copyvio_check_many(self, pages, **kwargs):
+        """Check many pages on this site for copyright violations.
+
+        *pages* is a list of :py:class:`~earwigbot.wiki.page.Page` objects or
+        page titles. This is a generator of ``(page, result)`` tuples, yielded
+        as each check finishes; see
+        :py:func:`~earwigbot.wiki.copyvios.copyvio_check_many` for the
+        arguments it accepts. Pages share search and source caches and are
+        checked concurrently, which makes this much faster than calling
+        :py:meth:`Page.copyvio_check()
+        <earwigbot.wiki.copyvios.CopyvioMixIn.copyvio_check>` in a loop.
+        """
+        pages = [self.get_page(page) if isinstance(page, basestring) else page
+                 for page in pages]
+        return copyvio_check_many(pages, **kwargs)
+
+    def get_revisions(self, revids, props="ids|timestamp|user|comment|content"):
+        """Iterate over information about the revisions with the given IDs.
+
+        This is useful when revision IDs are known ahead of time (for example,
+        from recent changes reported by the
+        :py:class:`~earwigbot.irc.watcher.Watcher`) and their content is
+        needed. *props* is a string or list of revision properties to load,
+        as understood by the API's ``rvprop``; ``"ids"`` is always included.
+
+        Revisions are loaded in batches of 50 per API query, and we yield a
+        dict for each one as its batch arrives, in the same order as
+        *revids*. Each dict is the revision as returned by the API (for
+        example, content is keyed as ``"*"``), plus the ``"pageid"``,
+        ``"title"``, and ``"ns"`` of its page. ``None`` is yielded for revision
+        IDs that don't exist or can't be viewed.
+
+        Raises :py:exc:`~earwigbot.exceptions.APIError` if there was an API
+        issue.
+        """
+        if isinstance(props, basestring):
+            props = props.split("|")
+        props = "|".join(["ids"] + [prop for prop in props if prop != "ids"])
+        revids = [int(revid) for revid in revids]
+
+        for i in xrange(0, len(revids), 50):
+            batch = revids[i:i + 50]
+            params = {"action": "query", "prop": "revisions", "rvprop": props,
+                      "revids": "|".join(str(revid) for revid in batch),
+                      "continue": ""}
+            found = {}
+            while True:
+                result = self.api_query(**params)
+                pages = result.get("query", {}).get("pages", {})
+                for page in pages.itervalues():
+                    for revision in page.get("revisions", []):
+                        revision["pageid"] = page["pageid"]
+                        revision["title"] = page["title"]
+                        revision["ns"] = page["ns"]
+                        found[revision["revid"]] = revision
+                if "continue" not in result:
+                    break
+                params.update(result["continue"])  # Content was too large
+
+            for revid in batch:
+                yield found.get(revid)
+
     def delegate(self, services, args=None, kwargs=None):
         """Delegate a task to either the API or SQL depending on conditions.
 
@@ -27,9 +27,12 @@ from os import chmod, path
 from platform import python_version
 import stat
 import sqlite3 as sqlite
+from threading import RLock
+from urlparse import urlparse
 
 from earwigbot import __version__
 from earwigbot.exceptions import SiteNotFoundError
+from earwigbot.wiki.copyvios.cache import QueryCache
 from earwigbot.wiki.copyvios.exclusions import ExclusionsDB
 from earwigbot.wiki.site import Site
 
@@ -48,6 +51,9 @@ class SitesDB(object):
     - :py:meth:`add_site`:    stores a site in the database
     - :py:meth:`remove_site`: removes a site from the database
 
+    Additionally, :py:meth:`import_sitematrix` can be used to fill the database
+    with every site in a wiki farm at once.
+
     There's usually no need to use this class directly. All public methods
     here are available as :py:meth:`bot.wiki.get_site`,
     :py:meth:`bot.wiki.add_site`, and :py:meth:`bot.wiki.remove_site`, which
@@ -66,9 +72,15 @@ class SitesDB(object):
         self._cookie_file = path.join(bot.config.root_dir, ".cookies")
         self._cookiejar = None
 
+        self._db_conn = None  # Persistent sitesdb connection
+        self._db_lock = RLock()
+        self._site_index = {}  # Site name -> site info tuple
+        self._site_names = {}  # (project, lang) -> site name
+
         excl_db = path.join(bot.config.root_dir, "exclusions.db")
         excl_logger = self._logger.getChild("exclusionsdb")
         self._exclusions_db = ExclusionsDB(self, excl_db, excl_logger)
+        self._query_cache = None
 
     def __repr__(self):
         """Return the canonical string representation of the SitesDB."""
@@ -112,7 +124,7 @@ class SitesDB(object):
 
         return self._cookiejar
 
-    def _create_sitesdb(self):
+    def _create_sitesdb(self, conn):
         """Initialize the sitesdb file with its three necessary tables."""
         script = """
         CREATE TABLE sites (site_name, site_project, site_lang, site_base_url,
@@ -120,9 +132,80 @@ class SitesDB(object):
         CREATE TABLE sql_data (sql_site, sql_data_key, sql_data_value);
         CREATE TABLE namespaces (ns_site, ns_id, ns_name, ns_is_primary_name);
         """
-        with sqlite.connect(self._sitesdb) as conn:
+        with conn:
             conn.executescript(script)
 
+    def _get_connection(self):
+        """Return our persistent connection to the sitesdb, opening it if needed.
+
+        The connection is shared by all threads and guarded by _db_lock, which
+        the caller must hold. It is put into write-ahead logging mode so other
+        processes using the same file aren't blocked while we write. On the
+        first call, an empty database is created if none exists, and the
+        in-memory site index is loaded.
+        """
+        if self._db_conn:
+            return self._db_conn
+
+        conn = sqlite.connect(self._sitesdb, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+        if not conn.execute(query, ("sites",)).fetchone():
+            self._create_sitesdb(conn)
+        self._db_conn = conn
+        self._load_index()
+        return conn
+
+    def _load_index(self):
+        """Fill our in-memory site index with every site in the sitesdb.
+
+        This is done once per connection; afterwards, _index_site() and
+        _unindex_site() keep the index coherent with the database.
+        """
+        query1 = "SELECT * FROM sites"
+        query2 = "SELECT sql_site, sql_data_key, sql_data_value FROM sql_data"
+        query3 = "SELECT ns_site, ns_id, ns_name, ns_is_primary_name FROM namespaces"
+        conn = self._db_conn
+        sql_data = {}
+        for site, key, value in conn.execute(query2):
+            sql_data.setdefault(site, {})[key] = value
+        ns_data = {}
+        for site, ns_id, ns_name, ns_is_primary_name in conn.execute(query3):
+            namespaces = ns_data.setdefault(site, {})
+            if ns_id not in namespaces:
+                namespaces[ns_id] = [ns_name]
+            elif ns_is_primary_name:  # "Primary" name goes first in list
+                namespaces[ns_id].insert(0, ns_name)
+            else:  # Ordering of the aliases doesn't matter
+                namespaces[ns_id].append(ns_name)
+
+        self._site_index = {}
+        self._site_names = {}
+        for row in conn.execute(query1):
+            name = row[0]
+            info = row + (sql_data.get(name, {}), ns_data.get(name, {}))
+            self._index_site(info)
+
+    def _index_site(self, info):
+        """Add a site's information tuple to our in-memory index."""
+        name, project, lang = info[:3]
+        self._site_index[name] = info
+        self._site_names.setdefault((project, lang), name)
+
+    def _unindex_site(self, name):
+        """Remove a site from our in-memory index, if it is present."""
+        try:
+            info = self._site_index.pop(name)
+        except KeyError:
+            return
+        key = info[1], info[2]
+        if self._site_names.get(key) == name:
+            del self._site_names[key]
+            for other in self._site_index.itervalues():
+                if (other[1], other[2]) == key:
+                    self._site_names[key] = other[0]
+                    break
+
     def _get_site_object(self, name):
         """Return the site from our cache, or create it if it doesn't exist.
 
@@ -144,36 +227,41 @@ class SitesDB(object):
         connection data, and namespaces, in that order. If the site is not
         found in the database, SiteNotFoundError will be raised. An empty
         database will be created before the exception is raised if none exists.
+
+        This is served from our in-memory index, so no queries are made after
+        the sitesdb has been opened for the first time. The SQL data and
+        namespaces are copied, since Site objects are free to modify them.
         """
-        query1 = "SELECT * FROM sites WHERE site_name = ?"
-        query2 = "SELECT sql_data_key, sql_data_value FROM sql_data WHERE sql_site = ?"
-        query3 = "SELECT ns_id, ns_name, ns_is_primary_name FROM namespaces WHERE ns_site = ?"
-        error = "Site '{0}' not found in the sitesdb.".format(name)
-        with sqlite.connect(self._sitesdb) as conn:
+        with self._db_lock:
+            self._get_connection()
             try:
-                site_data = conn.execute(query1, (name,)).fetchone()
-            except sqlite.OperationalError:
-                self._create_sitesdb()
-                raise SiteNotFoundError(error)
-            if not site_data:
+                info = self._site_index[name]
+            except KeyError:
+                error = "Site '{0}' not found in the sitesdb.".format(name)
                 raise SiteNotFoundError(error)
-            sql_data = conn.execute(query2, (name,)).fetchall()
-            ns_data = conn.execute(query3, (name,)).fetchall()
 
-        name, project, lang, base_url, article_path, script_path = site_data
-        sql = dict(sql_data)
-        namespaces = {}
-        for ns_id, ns_name, ns_is_primary_name in ns_data:
-            try:
-                if ns_is_primary_name:  # "Primary" name goes first in list
-                    namespaces[ns_id].insert(0, ns_name)
-                else:  # Ordering of the aliases doesn't matter
-                    namespaces[ns_id].append(ns_name)
-            except KeyError:
-                namespaces[ns_id] = [ns_name]
+        sql = dict(info[6])
+        namespaces = dict((ns_id, list(names))
+                          for ns_id, names in info[7].iteritems())
+        return info[:6] + (sql, namespaces)
+
+    def _get_query_cache(self, options):
+        """Return the search query cache, creating it if necessary.
 
-        return (name, project, lang, base_url, article_path, script_path, sql,
-                namespaces)
+        *options* is the value of ``queryCache`` in the search config: either
+        ``True``, or a dict that may contain *ttl* and *maxEntries*. The cache
+        is stored in :file:`queries.db` and shared by all sites.
+        """
+        if not self._query_cache:
+            dbfile = path.join(self.config.root_dir, "queries.db")
+            kwargs = {}
+            if isinstance(options, dict):
+                if "ttl" in options:
+                    kwargs["ttl"] = options["ttl"]
+                if "maxEntries" in options:
+                    kwargs["max_entries"] = options["maxEntries"]
+            self._query_cache = QueryCache(dbfile, **kwargs)
+        return self._query_cache
 
     def _make_site_object(self, name):
         """Return a Site object associated with the site *name* in our sitesdb.
@@ -203,6 +291,9 @@ class SitesDB(object):
             nltk_dir = path.join(self.config.root_dir, ".nltk")
             search_config["nltk_dir"] = nltk_dir
             search_config["exclusions_db"] = self._exclusions_db
+            if search_config.get("queryCache"):
+                search_config["query_cache"] = self._get_query_cache(
+                    search_config["queryCache"])
 
         if not sql:
             sql = config.wiki.get("sql", OrderedDict()).copy()
@@ -210,7 +301,7 @@ class SitesDB(object):
                 if isinstance(value, basestring) and "$1" in value:
                     sql[key] = value.replace("$1", name)
 
-        return Site(name=name, project=project, lang=lang, base_url=base_url,
+        site = Site(name=name, project=project, lang=lang, base_url=base_url,
                     article_path=article_path, script_path=script_path,
                     sql=sql, namespaces=namespaces, login=login,
                     cookiejar=cookiejar, user_agent=user_agent,
@@ -218,6 +309,12 @@ class SitesDB(object):
                     maxlag=maxlag, wait_between_queries=wait_between_queries,
                     logger=logger, search_config=search_config)
 
+        if not namespaces:
+            # Sites added by import_sitematrix() don't have their namespaces
+            # stored yet; the Site just loaded them, so save them for next time:
+            self._add_namespaces_to_sitesdb(name, site._namespaces)
+        return site
+
     def _get_site_name_from_sitesdb(self, project, lang):
         """Return the name of the first site with the given project and lang.
 
@@ -231,19 +328,15 @@ class SitesDB(object):
         If the site is not found, return None. An empty sitesdb will be created
         if none exists.
         """
-        query1 = "SELECT site_name FROM sites WHERE site_project = ? and site_lang = ?"
-        query2 = "SELECT site_name FROM sites WHERE site_base_url LIKE ?"
-        with sqlite.connect(self._sitesdb) as conn:
+        with self._db_lock:
+            self._get_connection()
             try:
-                site = conn.execute(query1, (project, lang)).fetchone()
-                if site:
-                    return site[0]
-                else:
-                    url = "%{0}.{1}%".format(lang, project)
-                    site = conn.execute(query2, (url,)).fetchone()
-                    return site[0] if site else None
-            except sqlite.OperationalError:
-                self._create_sitesdb()
+                return self._site_names[(project, lang)]
+            except KeyError:
+                url = "{0}.{1}".format(lang, project).lower()
+                for info in self._site_index.itervalues():
+                    if info[3] and url in info[3].lower():  # Like SQL LIKE
+                        return info[0]
 
     def _add_site_to_sitesdb(self, site):
         """Extract relevant info from a Site object and add it to the sitesdb.
@@ -257,26 +350,47 @@ class SitesDB(object):
         sites_data = (name, site.project, site.lang, site._base_url,
                       site._article_path, site._script_path)
         sql_data = [(name, key, val) for key, val in site._sql_data.iteritems()]
-        ns_data = []
-        for ns_id, ns_names in site._namespaces.iteritems():
-            ns_data.append((name, ns_id, ns_names.pop(0), True))
-            for ns_name in ns_names:
-                ns_data.append((name, ns_id, ns_name, False))
+        ns_data = self._get_namespace_rows(name, site._namespaces)
 
-        with sqlite.connect(self._sitesdb) as conn:
-            check_exists = "SELECT 1 FROM sites WHERE site_name = ?"
-            try:
-                exists = conn.execute(check_exists, (name,)).fetchone()
-            except sqlite.OperationalError:
-                self._create_sitesdb()
-            else:
-                if exists:
+        with self._db_lock:
+            conn = self._get_connection()
+            with conn:
+                if name in self._site_index:
                     conn.execute("DELETE FROM sites WHERE site_name = ?", (name,))
                     conn.execute("DELETE FROM sql_data WHERE sql_site = ?", (name,))
                     conn.execute("DELETE FROM namespaces WHERE ns_site = ?", (name,))
-            conn.execute("INSERT INTO sites VALUES (?, ?, ?, ?, ?, ?)", sites_data)
-            conn.executemany("INSERT INTO sql_data VALUES (?, ?, ?)", sql_data)
-            conn.executemany("INSERT INTO namespaces VALUES (?, ?, ?, ?)", ns_data)
+                conn.execute("INSERT INTO sites VALUES (?, ?, ?, ?, ?, ?)", sites_data)
+                conn.executemany("INSERT INTO sql_data VALUES (?, ?, ?)", sql_data)
+                conn.executemany("INSERT INTO namespaces VALUES (?, ?, ?, ?)", ns_data)
+
+            namespaces = dict((ns_id, list(names))
+                              for ns_id, names in site._namespaces.iteritems())
+            self._unindex_site(name)
+            self._index_site(sites_data + (dict(site._sql_data), namespaces))
+
+    def _get_namespace_rows(self, name, namespaces):
+        """Return a list of rows for the namespaces table for the given site."""
+        ns_data = []
+        for ns_id, ns_names in namespaces.iteritems():
+            ns_data.append((name, ns_id, ns_names[0], True))
+            for ns_name in ns_names[1:]:
+                ns_data.append((name, ns_id, ns_name, False))
+        return ns_data
+
+    def _add_namespaces_to_sitesdb(self, name, namespaces):
+        """Store the namespaces of a site already in the sitesdb."""
+        ns_data = self._get_namespace_rows(name, namespaces)
+        with self._db_lock:
+            conn = self._get_connection()
+            if name not in self._site_index:
+                return
+            with conn:
+                conn.execute("DELETE FROM namespaces WHERE ns_site = ?", (name,))
+                conn.executemany("INSERT INTO namespaces VALUES (?, ?, ?, ?)", ns_data)
+            info = self._site_index[name]
+            namespaces = dict((ns_id, list(names))
+                              for ns_id, names in namespaces.iteritems())
+            self._site_index[name] = info[:7] + (namespaces,)
 
     def _remove_site_from_sitesdb(self, name):
         """Remove a site by name from the sitesdb and the internal cache."""
@@ -285,15 +399,17 @@ class SitesDB(object):
         except KeyError:
             pass
 
-        with sqlite.connect(self._sitesdb) as conn:
-            cursor = conn.execute("DELETE FROM sites WHERE site_name = ?", (name,))
-            if cursor.rowcount == 0:
-                return False
-            else:
+        with self._db_lock:
+            conn = self._get_connection()
+            with conn:
+                cursor = conn.execute("DELETE FROM sites WHERE site_name = ?", (name,))
+                if cursor.rowcount == 0:
+                    return False
                 conn.execute("DELETE FROM sql_data WHERE sql_site = ?", (name,))
                 conn.execute("DELETE FROM namespaces WHERE ns_site = ?", (name,))
-                self._logger.info("Removed site '{0}'".format(name))
-                return True
+            self._unindex_site(name)
+        self._logger.info("Removed site '{0}'".format(name))
+        return True
 
     def get_site(self, name=None, project=None, lang=None):
         """Return a Site instance based on information from the sitesdb.
@@ -436,3 +552,69 @@ class SitesDB(object):
                 return self._remove_site_from_sitesdb(name)
 
         return False
+
+    def import_sitematrix(self, site=None, overwrite=False):
+        """Add every site in a wiki farm to the sitesdb in one transaction.
+
+        The list of sites is loaded from the ``action=sitematrix`` API module
+        of *site*, which defaults to our default site. This is available on
+        Wikimedia wikis and others using the SiteMatrix extension. Private
+        sites are skipped. Sites already in the sitesdb are left alone unless
+        *overwrite* is ``True``.
+
+        No other API queries are made, so a site's namespaces are only loaded
+        (and then stored) the first time it is retrieved with
+        :py:meth:`get_site`. Imported sites are assumed to use ``"/w"`` as
+        their script path and ``"/wiki/$1"`` as their article path.
+
+        Returns the number of sites that were added.
+        """
+        if not site:
+            site = self.get_site()
+        result = site.api_query(action="sitematrix", smlangprop="code|site",
+                                smsiteprop="url|dbname|code|sitename|lang")
+        matrix = result["sitematrix"]
+
+        entries = []
+        for key, group in matrix.iteritems():
+            if key == "count":
+                continue
+            if key == "specials":
+                for special in group:
+                    entries.append((special, special.get("lang", "en")))
+            else:
+                for entry in group.get("site", []):
+                    entries.append((entry, group["code"]))
+
+        sites_data = []
+        with self._db_lock:
+            conn = self._get_connection()
+            for entry, lang in entries:
+                name = entry["dbname"]
+                if "private" in entry:
+                    continue
+                if name in self._site_index and not overwrite:
+                    continue
+                base_url = "//" + urlparse(entry["url"]).netloc
+                project = entry["sitename"].lower()
+                sites_data.append((name, project, lang, base_url, "/wiki/$1",
+                                   "/w"))
+
+            with conn:
+                for data in sites_data:
+                    name = data[0]
+                    if name in self._site_index:
+                        conn.execute("DELETE FROM sites WHERE site_name = ?", (name,))
+                        conn.execute("DELETE FROM sql_data WHERE sql_site = ?", (name,))
+                        conn.execute("DELETE FROM namespaces WHERE ns_site = ?", (name,))
+                conn.executemany("INSERT INTO sites VALUES (?, ?, ?, ?, ?, ?)",
+                                 sites_data)
+
+            for data in sites_data:
+                self._unindex_site(data[0])
+                self._sites.pop(data[0], None)
+                self._index_site(data + ({}, {}))
+
+        log = "Imported {0} sites from the sitematrix of '{1}'"
+        self._logger.info(log.format(len(sites_data), site.name))
+        return len(sites_data)
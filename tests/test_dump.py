@@ -0,0 +1,187 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2009-2015 Ben Kurtovic <ben.kurtovic@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from bz2 import BZ2File, compress
+from os import path
+import shutil
+import tempfile
+import unittest
+
+from earwigbot.wiki import constants
+from earwigbot.wiki.dump import DumpSite, _BZ2Reader, iter_dump
+
+HEADER = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">
+  <siteinfo>
+    <dbname>testwiki</dbname>
+    <namespaces>
+      <namespace key="0" />
+      <namespace key="1">Talk</namespace>
+    </namespaces>
+  </siteinfo>
+"""
+PAGE = u"""  <page>
+    <title>{title}</title>
+    <ns>{ns}</ns>
+    <id>{pageid}</id>{redirect}
+    <revision>
+      <id>{revid}</id>
+      <text>{text}</text>
+    </revision>
+  </page>
+"""
+FOOTER = "</mediawiki>\n"
+
+class FakeSite(object):
+    """Stands in for a live Site, recording the pages asked of it."""
+
+    def get_page(self, title, follow_redirects=False, pageid=None):
+        return (title, follow_redirects, pageid)
+
+def summarize(page):
+    """Describe a page by the fields read from the dump (used by map())."""
+    return (page.title, page.namespace, page.pageid, page.lastrevid,
+            page.get(), page.is_redirect)
+
+def talk_only(page):
+    """Keep the titles of talk pages only (used by map())."""
+    return page.title if page.is_talkpage else None
+
+class TestDump(unittest.TestCase):
+    NUM_STREAMS = 7
+    PAGES_PER_STREAM = 3
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pages = []
+        streams = []
+        for i in xrange(self.NUM_STREAMS):
+            chunk = []
+            for j in xrange(self.PAGES_PER_STREAM):
+                pageid = i * self.PAGES_PER_STREAM + j + 1
+                page = (u"Pagé {0}".format(pageid), pageid % 2, pageid,
+                        1000 + pageid, u"text of {0} ".format(pageid) * 20,
+                        pageid % 5 == 0)
+                self.pages.append(page)
+                chunk.append(PAGE.format(
+                    title=page[0], ns=page[1], pageid=page[2],
+                    revid=page[3], text=page[4],
+                    redirect='\n    <redirect title="X" />' if page[5]
+                    else ""))
+            streams.append(u"".join(chunk).encode("utf8"))
+
+        xml = HEADER + "".join(streams) + FOOTER
+        self.plain = path.join(self.dir, "testwiki-pages.xml")
+        with open(self.plain, "wb") as fp:
+            fp.write(xml)
+        self.single = path.join(self.dir, "testwiki-pages.xml.bz2")
+        with open(self.single, "wb") as fp:
+            fp.write(compress(xml))
+
+        self.multi = path.join(self.dir, "testwiki-multistream.xml.bz2")
+        index = []
+        with open(self.multi, "wb") as fp:
+            fp.write(compress(HEADER))
+            for i, stream in enumerate(streams):
+                offset = fp.tell()
+                for j in xrange(self.PAGES_PER_STREAM):
+                    page = self.pages[i * self.PAGES_PER_STREAM + j]
+                    line = u"{0}:{1}:{2}\n".format(offset, page[2], page[0])
+                    index.append(line.encode("utf8"))
+                fp.write(compress(stream))
+            fp.write(compress(FOOTER))
+        index_path = path.join(self.dir, "testwiki-multistream-index.txt.bz2")
+        index_file = BZ2File(index_path, "w")
+        index_file.write("".join(index))
+        index_file.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_pages(self):
+        """Every kind of dump gives the same pages."""
+        for dump in (self.plain, self.single, self.multi):
+            site = DumpSite(dump)
+            self.assertEqual(u"testwiki", site.name)
+            self.assertEqual(u"Talk", site.namespace_id_to_name(1))
+            pages = [summarize(page) for page in site.get_pages()]
+            self.assertEqual(self.pages, pages)
+
+    def test_namespaces_and_refs(self):
+        talk = [page for page in self.pages if page[1] == constants.NS_TALK]
+        pages = iter_dump(self.multi, namespaces=[constants.NS_TALK])
+        self.assertEqual(talk, [summarize(page) for page in pages])
+        refs = list(iter_dump(self.plain, refs=True))
+        self.assertEqual([(page[0], page[1], page[2]) for page in self.pages],
+                         [(ref.title, ref.namespace, ref.pageid)
+                          for ref in refs])
+
+    def test_refs_to_pages(self):
+        """Dump refs need a live site to become pages."""
+        ref = next(iter_dump(self.plain, refs=True))
+        self.assertRaises(ValueError, ref.to_page)
+        self.assertEqual((self.pages[0][0], True, None),
+                         ref.to_page(True, site=FakeSite()))
+
+    def test_small_blocks(self):
+        """Streams that end in the middle of or exactly on a block are read."""
+        with open(self.multi, "rb") as fp:
+            expected = _BZ2Reader(fp).read()
+        self.assertTrue(expected.startswith(HEADER))
+        self.assertTrue(expected.endswith(FOOTER))
+        for size in (1, 7, 64, 1000):
+            with open(self.multi, "rb") as fp:
+                reader = _BZ2Reader(fp)
+                reader.BLOCK_SIZE = size
+                chunks = []
+                while True:
+                    data = reader.read(13)
+                    if not data:
+                        break
+                    chunks.append(data)
+            self.assertEqual(expected, "".join(chunks))
+
+    def test_ranges(self):
+        """Splitting the dump into ranges neither loses nor repeats pages."""
+        site = DumpSite(self.multi)
+        for per_range in (1, 2, 3, self.NUM_STREAMS, self.NUM_STREAMS + 1):
+            ranges = site._get_ranges(per_range)
+            expected = (self.NUM_STREAMS + per_range - 1) / per_range
+            self.assertEqual(expected, len(ranges))
+            self.assertEqual(None, ranges[-1][1])
+            pages = []
+            for start, end in ranges:
+                pages.extend(summarize(page)
+                             for page in site._iter_range(start, end))
+            self.assertEqual(self.pages, pages)
+
+    def test_map(self):
+        site = DumpSite(self.multi)
+        self.assertEqual(self.pages,
+                         list(site.map(summarize, 2, streams_per_range=2)))
+        talk = [page[0] for page in self.pages if page[1] % 2]
+        self.assertEqual(talk, list(site.map(talk_only, 2)))
+        plain = DumpSite(self.plain)
+        self.assertEqual(talk, list(plain.map(talk_only)))
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2009-2015 Ben Kurtovic <ben.kurtovic@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import random
+import re
+import unittest
+
+from earwigbot.wiki.copyvios.exclusions import _ExclusionsMatcher, _NORMALIZE
+
+class TestExclusionsMatcher(unittest.TestCase):
+
+    def matches(self, exclusions, url):
+        """Return whether a URL is matched by the given exclusions."""
+        lowered = url.lower()
+        normalized = _NORMALIZE.sub("", lowered)
+        return _ExclusionsMatcher(exclusions).match(lowered, normalized)
+
+    def old_matches(self, exclusions, url):
+        """Check plain and ``re:`` exclusions the way check() used to."""
+        normalized = re.sub(r"^https?://(www\.)?", "", url.lower())
+        for excl in exclusions:
+            if excl.startswith("re:"):
+                try:
+                    if re.match(excl[3:], normalized):
+                        return True
+                except re.error:
+                    continue
+            elif normalized.startswith(excl):
+                return True
+        return False
+
+    def test_domains(self):
+        excl = ["*.example.com", "*.mirror.org/wiki/"]
+        self.assertTrue(self.matches(excl, "http://example.com/foo"))
+        self.assertTrue(self.matches(excl, "https://a.b.Example.com/"))
+        self.assertFalse(self.matches(excl, "http://notexample.com/"))
+        self.assertFalse(self.matches(excl, "http://example.com.au/"))
+        self.assertTrue(self.matches(excl, "http://en.mirror.org/wiki/Foo"))
+        self.assertFalse(self.matches(excl, "http://en.mirror.org/w/Foo"))
+        self.assertFalse(self.matches(excl, "not a url"))
+
+    def test_prefixes(self):
+        excl = ["en.wikipedia.org/", "example.com/mirror", ""]
+        self.assertTrue(self.matches(excl, "http://www.example.com/mirror/1"))
+        self.assertTrue(self.matches(excl, "https://en.wikipedia.org/wiki/A"))
+        self.assertFalse(self.matches(excl, "http://example.com/other"))
+        self.assertFalse(self.matches(excl, "http://de.wikipedia.org/"))
+        self.assertFalse(self.matches([], "http://example.com/"))
+
+    def test_regexes(self):
+        excl = ["re:[a-z]+\\.example\\.(com|org)/", "re:(", "re:(a)\\1b/",
+                "re:(?i)UPPER\\.net", "re:(?P<x>y)+\\.info"]
+        self.assertTrue(self.matches(excl, "http://foo.example.org/x"))
+        self.assertFalse(self.matches(excl, "http://foo.example.net/x"))
+        self.assertTrue(self.matches(excl, "http://aab/"))
+        self.assertTrue(self.matches(excl, "http://upper.net/"))
+        self.assertTrue(self.matches(excl, "http://yyy.info/"))
+        self.assertFalse(self.matches(excl, "http://z.info/"))
+
+    def test_regex_group_limit(self):
+        excl = ["re:(x)(y{0})".format(i) for i in xrange(150)]
+        matcher = _ExclusionsMatcher(excl)
+        self.assertTrue(len(matcher._regexes) > 1)
+        for regex in matcher._regexes:
+            self.assertTrue(regex.groups <= _ExclusionsMatcher.MAX_GROUPS)
+        self.assertTrue(matcher.match("xy149", "xy149"))
+        self.assertTrue(matcher.match("xy0", "xy0"))
+        self.assertFalse(matcher.match("yx0", "yx0"))
+
+    def test_same_as_old_check(self):
+        """Plain and re: exclusions must match exactly what they used to."""
+        rand = random.Random(0)
+        words = ["a", "ab", "b", "ba", "c", ".", "/", "-"]
+        make = lambda n: "".join(rand.choice(words) for _ in xrange(n))
+        for _ in xrange(300):
+            excl = []
+            for _ in xrange(rand.randint(0, 8)):
+                if rand.random() < 0.4:
+                    excl.append("re:" + rand.choice(
+                        ["{0}", "{0}.*", "({0})+", "[ab]{0}", "{0}|{0}c",
+                         "(", "(a)\\1{0}"]).format(re.escape(make(2))))
+                else:
+                    excl.append(make(rand.randint(1, 4)))
+            for _ in xrange(10):
+                prefix = rand.choice(["http://", "https://www.", ""])
+                url = prefix + make(rand.randint(0, 6))
+                self.assertEqual(self.old_matches(excl, url),
+                                 self.matches(excl, url), (excl, url))
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2009-2015 Ben Kurtovic <ben.kurtovic@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import random
+import unittest
+
+from earwigbot.wiki.copyvios.markov import HashedMarkovChain, MarkovChain
+
+WORDS = u"the of and to in is was for on as by with that from at it".split()
+
+class TestMarkovPatch(unittest.TestCase):
+    """Check that patching a chain gives the same chain as rebuilding it."""
+
+    def setUp(self):
+        self.rand = random.Random(42)
+
+    def make_paragraph(self):
+        """Return a random paragraph, sometimes empty or very short."""
+        length = self.rand.choice([0, 1, 2, 5, 20])
+        return u" ".join(self.rand.choice(WORDS) for _ in xrange(length))
+
+    def make_revisions(self):
+        """Return two random texts, the second an edit of the first."""
+        paras = [self.make_paragraph()
+                 for _ in xrange(self.rand.randint(0, 30))]
+        old = u"\n".join(paras)
+        for _ in xrange(self.rand.randint(0, 5)):
+            action = self.rand.choice(["add", "remove", "change"])
+            index = self.rand.randint(0, len(paras))
+            if action == "add":
+                paras.insert(index, self.make_paragraph())
+            elif paras and index < len(paras):
+                if action == "remove":
+                    del paras[index]
+                else:
+                    paras[index] = self.make_paragraph()
+        return old, u"\n".join(paras)
+
+    def assertSameChain(self, patched, rebuilt):
+        self.assertEqual(rebuilt.size, patched.size)
+        if isinstance(rebuilt, HashedMarkovChain):
+            self.assertEqual(list(rebuilt.hashes), list(patched.hashes))
+            self.assertEqual(list(rebuilt.counts), list(patched.counts))
+        else:
+            normalize = lambda chain: dict(
+                (prefix, dict((node, count) for node, count in nodes.items()
+                              if count))
+                for prefix, nodes in chain.chain.items()
+                if any(nodes.values()))
+            self.assertEqual(normalize(rebuilt), normalize(patched))
+
+    def test_patch_equals_rebuild(self):
+        """test that patched chains match rebuilt ones for random edits"""
+        for chain_class in (MarkovChain, HashedMarkovChain):
+            for _ in xrange(300):
+                old, new = self.make_revisions()
+                patched = chain_class(old).patch(old, new)
+                self.assertSameChain(patched, chain_class(new))
+
+    def test_patch_keeps_original(self):
+        """test that patching a chain doesn't change the original"""
+        old = u"\n".join(u"one two three four {0}".format(i)
+                         for i in xrange(50))
+        new = old.replace(u"four 7", u"five 7")
+        for chain_class in (MarkovChain, HashedMarkovChain):
+            chain = chain_class(old)
+            chain.patch(old, new)
+            self.assertSameChain(chain, chain_class(old))
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2009-2015 Ben Kurtovic <ben.kurtovic@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from os import path
+import unittest
+
+from earwigbot.wiki.copyvios.parsers import ArticleTextParser
+
+class FakeTokenizer(object):
+    """Splits text into sentences on ``|``, so nltk's data isn't needed."""
+
+    def tokenize(self, text):
+        return text.split("|")
+
+class TestArticleChunks(unittest.TestCase):
+    NLTK_DIR = "fake-nltk"
+
+    def setUp(self):
+        datafile = path.join(self.NLTK_DIR, "tokenizers", "punkt",
+                             "english.pickle")
+        ArticleTextParser._tokenizers[datafile] = FakeTokenizer()
+
+    def tearDown(self):
+        ArticleTextParser._tokenizers.clear()
+
+    def chunk(self, sentences, max_chunks):
+        """Return the chunks picked from the given sentences."""
+        parser = ArticleTextParser(u"")
+        parser.clean = u"|".join(sentences)
+        return parser.chunk(self.NLTK_DIR, max_chunks)
+
+    def old_chunk(self, sentences, max_chunks):
+        """Pick chunks by popping from the list, like chunk() used to."""
+        sentences = list(sentences)
+        if max_chunks >= len(sentences):
+            return sentences
+        chunks = []
+        while len(chunks) < max_chunks:
+            if len(chunks) % 5 == 0:
+                chunk = sentences.pop(0)
+            elif len(chunks) % 5 == 1:
+                chunk = sentences.pop()
+            elif len(chunks) % 5 == 2:
+                chunk = sentences.pop(len(sentences) / 2)
+            elif len(chunks) % 5 == 3:
+                chunk = sentences.pop(len(sentences) / 4)
+            else:
+                chunk = sentences.pop(3 * len(sentences) / 4)
+            chunks.append(chunk)
+        return chunks
+
+    def test_same_as_old_chunk(self):
+        """Chunks must be picked in the same order as before."""
+        for num in xrange(60):
+            sentences = [u"sentence number {0}".format(i) for i in xrange(num)]
+            for max_chunks in xrange(num + 2):
+                self.assertEqual(self.old_chunk(sentences, max_chunks),
+                                 self.chunk(sentences, max_chunks))
+
+    def test_sentence_limits(self):
+        """Short sentences are dropped, and long ones cut at a word."""
+        long_sentence = u" ".join([u"word"] * 40)
+        chunks = self.chunk([u"tiny", long_sentence, u"just right"], 5)
+        self.assertEqual(2, len(chunks))
+        self.assertTrue(len(chunks[0]) <= 128)
+        self.assertTrue(long_sentence.startswith(chunks[0]))
+        self.assertEqual(u"just right", chunks[1])
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
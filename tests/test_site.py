@@ -0,0 +1,83 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2009-2015 Ben Kurtovic <ben.kurtovic@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import unittest
+
+from earwigbot.wiki import Site
+
+class FakeSite(Site):
+    """A Site that answers its siteinfo query without the network."""
+
+    def __init__(self):
+        self.queries = 0
+        namespaces = {0: [u""], 1: [u"Talk"], 2: [u"User"],
+                      4: [u"Wikipedia", u"WP", u"Project"],
+                      14: [u"Category"], 100: [u"Gadget"]}
+        super(FakeSite, self).__init__(
+            name="testwiki", project="wikipedia", lang="en",
+            base_url="//en.wikipedia.org", article_path="/wiki/$1",
+            script_path="/w", namespaces=namespaces)
+
+    def api_query(self, **kwargs):
+        self.queries += 1
+        namespaces = dict((str(i), {"id": i}) for i in (0, 1, 2, 4, 14))
+        namespaces["100"] = {"id": 100, "case": "case-sensitive"}
+        return {"query": {
+            "general": {"case": "first-letter"},
+            "namespaces": namespaces,
+            "interwikimap": [{"prefix": "de"}, {"prefix": "Wiktionary"}]}}
+
+class TestNormalizeTitle(unittest.TestCase):
+
+    def setUp(self):
+        self.site = FakeSite()
+
+    def test_main_namespace(self):
+        norm = self.site.normalize_title
+        self.assertEqual(u"Foo bar", norm(u"foo_bar"))
+        self.assertEqual(u"Foo bar", norm(u"  foo \t__ bar "))
+        self.assertEqual(u"Foo", norm(u":foo"))
+        self.assertEqual(u"Éclair", norm(u"éclair"))
+        self.assertEqual(u"Not a namespace:x", norm(u"not a namespace:x"))
+        self.assertEqual(u"", norm(u""))
+
+    def test_namespaces(self):
+        norm = self.site.normalize_title
+        self.assertEqual(u"Wikipedia:Sandbox", norm(u"wp:sandbox"))
+        self.assertEqual(u"Wikipedia:Sandbox", norm(u"PROJECT : sandbox"))
+        self.assertEqual(u"Talk:Foo", norm(u"talk:foo"))
+        self.assertEqual(u"Category:Foo", norm(u":category:_foo"))
+        self.assertEqual(u"Gadget:foo", norm(u"gadget:foo"))
+
+    def test_interwikis(self):
+        norm = self.site.normalize_title
+        self.assertEqual(u"de:foo bar", norm(u"DE:foo_bar"))
+        self.assertEqual(u"wiktionary:word", norm(u"Wiktionary:word"))
+
+    def test_single_query(self):
+        for title in (u"a", u"wp:b", u"de:c", u"d"):
+            self.site.normalize_title(title)
+        self.assertEqual(1, self.site.queries)
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
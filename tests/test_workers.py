@@ -0,0 +1,125 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2009-2015 Ben Kurtovic <ben.kurtovic@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import socket
+from threading import Event, Thread
+from time import sleep, time
+import unittest
+from urllib2 import build_opener
+
+from earwigbot.wiki.copyvios.result import CopyvioSource
+from earwigbot.wiki.copyvios.workers import _CopyvioWorker
+
+class FakeWorkspace(object):
+    """Just enough of a CopyvioWorkspace for a worker to open URLs."""
+    source_cache = None
+
+class TestOpenURL(unittest.TestCase):
+    BODY = "alpha beta gamma delta epsilon zeta eta theta"
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        self.stopped = Event()
+        self.worker = _CopyvioWorker("test", None)
+
+    def tearDown(self):
+        self.stopped.set()
+        self.server.close()
+        self.worker._connections.close_all()
+
+    def serve(self, respond):
+        """Answer each request on the server socket with *respond*."""
+        def run():
+            while not self.stopped.is_set():
+                try:
+                    conn, _ = self.server.accept()
+                except socket.error:
+                    return
+                try:
+                    while not self.stopped.is_set():
+                        if not conn.recv(4096):
+                            break
+                        respond(conn)
+                except socket.error:
+                    pass
+                finally:
+                    conn.close()
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def respond_ok(self, conn):
+        conn.sendall("HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n"
+                     "Content-Length: {0}\r\n\r\n{1}".format(
+                         len(self.BODY), self.BODY))
+
+    def respond_drip(self, conn):
+        conn.sendall("HTTP/1.1 200 OK\r\n")
+        while not self.stopped.is_set():  # One header byte at a time
+            conn.sendall("X")
+            sleep(0.1)
+
+    def open(self, path):
+        """Open a URL on our server with a one-second timeout."""
+        url = u"http://127.0.0.1:{0}/{1}".format(self.port, path)
+        source = CopyvioSource(FakeWorkspace(), url, timeout=1)
+        start = time()
+        return self.worker._open_url(source), time() - start
+
+    def test_normal_response(self):
+        self.serve(self.respond_ok)
+        text, _ = self.open("a")
+        self.assertEqual(self.BODY, text)
+        text, _ = self.open("b")  # Over the kept-alive connection
+        self.assertEqual(self.BODY, text)
+
+    def test_default_timeout(self):
+        """Connections opened without a timeout can be reused."""
+        self.serve(self.respond_ok)
+        opener = build_opener(self.worker._connections)
+        url = "http://127.0.0.1:{0}/".format(self.port)
+        for _ in xrange(3):
+            self.assertEqual(self.BODY, opener.open(url).read())
+
+    def test_dripping_headers(self):
+        """A server sending headers slowly is cut off at the deadline."""
+        self.serve(self.respond_drip)
+        text, elapsed = self.open("drip")
+        self.assertEqual(None, text)
+        self.assertTrue(elapsed < _CopyvioWorker.DEADLINE_FACTOR + 2)
+
+    def test_dripping_headers_on_reused_connection(self):
+        responses = [self.respond_ok, self.respond_drip]
+        self.serve(lambda conn: responses.pop(0)(conn))
+        text, _ = self.open("a")
+        self.assertEqual(self.BODY, text)
+        text, elapsed = self.open("drip")
+        self.assertEqual(None, text)
+        self.assertTrue(elapsed < _CopyvioWorker.DEADLINE_FACTOR + 2)
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)